@@ -5,6 +5,18 @@
  * This wrapper sends UDP messages to CacheLRUDaemon on each group of
  * cache id reading/writing. The real sending is performed on script
  * shutdown to pack all requests to the same message and save bandwidth.
+ *
+ * If $sectionId is passed (it must match section_id option of the
+ * collection's section in cachelrud.conf), the compact binary protocol v2
+ * is used: sorted ids with shared prefixes, zlib-compressed if possible.
+ *
+ * If $host is "unix:///path/to/socket", messages are sent to the unix
+ * domain datagram socket of a local daemon (see listen_unix_path option):
+ * they are never dropped silently and may be much larger. Writes to it
+ * block while the daemon's receive queue is full.
+ *
+ * No message is larger than the daemon's receive buffer: ids which do not
+ * fit into a message alone are skipped (and logged).
  */
 require_once "Zend/Cache/Backend/ExtendedInterface.php";
 
@@ -12,6 +24,13 @@ class Zend_Cache_Backend_CacheLRUdWrapper implements Zend_Cache_Backend_Extended
 {
     const DEFAULT_PORT = 43521;
     const MAX_MSG_SIZE = 10240;
+    const MAX_BINARY_MSG_SIZE = 60000;
+    const MAX_UNIX_MSG_SIZE = 200000; // below the default net.core.wmem_default and the daemon's UNIX_BUF_SIZE
+    const BINARY_HEADER_MAX_SIZE = 9; // magic, version, flags, section id and a varint count
+    const UNIX_PREFIX = "unix://";
+    const BINARY_MAGIC = "\xC1";
+    const BINARY_VERSION = 2;
+    const BINARY_FLAG_ZLIB = 1;
 
     /**
      * @var Zend_Cache_Backend_ExtendedInterface
@@ -38,6 +57,11 @@ class Zend_Cache_Backend_CacheLRUdWrapper implements Zend_Cache_Backend_Extended
      */
     private $_logger = null;
 
+    /**
+     * @var int
+     */
+    private $_sectionId = null;
+
     /**
      * @var array
      */
@@ -46,17 +70,19 @@ class Zend_Cache_Backend_CacheLRUdWrapper implements Zend_Cache_Backend_Extended
     /**
      * @param Zend_Cache_Backend_Interface $backend
      * @param string $collectionName
-     * @param string $host
+     * @param string $host  Host name or "unix:///path/to/socket".
      * @param int $port
      * @param callback $logger  Accepts 2 arguments: function(string $message, float $exec_time_seconds)
+     * @param int $sectionId  If passed, binary protocol is used.
      */
-    public function __construct($backend, $collectionName, $host, $port = null, $logger = null)
+    public function __construct($backend, $collectionName, $host, $port = null, $logger = null, $sectionId = null)
     {
         $this->_backend = $backend;
         $this->_collectionName = $collectionName;
         $this->_host = $host;
         $this->_port = $port? $port : self::DEFAULT_PORT;
         $this->_logger = $logger;
+        $this->_sectionId = $sectionId;
         register_shutdown_function(array($this, 'flushHits'));
     }
 
@@ -66,16 +92,31 @@ class Zend_Cache_Backend_CacheLRUdWrapper implements Zend_Cache_Backend_Extended
     public function flushHits()
     {
         $t0 = microtime(true);
-        $socket = stream_socket_client("udp://{$this->_host}:{$this->_port}");
+        // Connecting to a unix socket fails if the daemon is not running.
+        $socket = @stream_socket_client($this->_getAddress());
         if (!$socket) {
             return;
         }
-        stream_set_blocking($socket, 0); // possibly useless?
-        $this->_log("UDP client socket created", microtime(true) - $t0);
+        if (!$this->_isUnix()) {
+            // A unix socket has backpressure: a non-blocking write to it
+            // fails instead of waiting while the daemon's queue is full.
+            stream_set_blocking($socket, 0);
+        }
+        $this->_log("client socket created", microtime(true) - $t0);
+        if ($this->_sectionId !== null) {
+            $this->_flushBinary($socket);
+            $this->_buf = array();
+            return;
+        }
         $lines = "";
+        $maxSize = $this->_getMaxMsgSize(self::MAX_MSG_SIZE);
         foreach ($this->_buf as $id => $dummy) {
             $line = $this->_collectionName . ":" . $id . "\n";
-            if (strlen($lines) + strlen($line) > self::MAX_MSG_SIZE) {
+            if (strlen($line) > $maxSize) {
+                $this->_log(sprintf("skipping id with %d bytes, it does not fit into a message", strlen($id)), 0);
+                continue;
+            }
+            if (strlen($lines) + strlen($line) > $maxSize) {
                 $this->_socketWrite($socket, $lines);
                 $lines = "";
             }
@@ -85,6 +126,87 @@ class Zend_Cache_Backend_CacheLRUdWrapper implements Zend_Cache_Backend_Extended
         $this->_buf = array();
     }
 
+    private function _isUnix()
+    {
+        return strpos($this->_host, self::UNIX_PREFIX) === 0;
+    }
+
+    private function _getAddress()
+    {
+        if ($this->_isUnix()) {
+            return "udg://" . substr($this->_host, strlen(self::UNIX_PREFIX));
+        }
+        return "udp://{$this->_host}:{$this->_port}";
+    }
+
+    private function _getMaxMsgSize($udpSize)
+    {
+        return $this->_isUnix()? self::MAX_UNIX_MSG_SIZE : $udpSize;
+    }
+
+    private function _flushBinary($socket)
+    {
+        $ids = array();
+        foreach ($this->_buf as $id => $dummy) {
+            $ids[] = (string)$id; // numeric array keys become integers
+        }
+        sort($ids, SORT_STRING);
+        $body = "";
+        $count = 0;
+        $prev = "";
+        $maxSize = $this->_getMaxMsgSize(self::MAX_BINARY_MSG_SIZE) - self::BINARY_HEADER_MAX_SIZE;
+        foreach ($ids as $id) {
+            if (strlen(self::_binaryEntry("", $id)) > $maxSize) {
+                $this->_log(sprintf("skipping id with %d bytes, it does not fit into a message", strlen($id)), 0);
+                continue;
+            }
+            $entry = self::_binaryEntry($prev, $id);
+            if (strlen($body) + strlen($entry) > $maxSize) {
+                $this->_socketWrite($socket, $this->_binaryPacket($body, $count));
+                $body = "";
+                $count = 0;
+                $entry = self::_binaryEntry("", $id);
+            }
+            $body .= $entry;
+            $count++;
+            $prev = $id;
+        }
+        if ($count) {
+            $this->_socketWrite($socket, $this->_binaryPacket($body, $count));
+        }
+    }
+
+    private function _binaryPacket($body, $count)
+    {
+        $payload = chr($this->_sectionId) . self::_varint($count) . $body;
+        $flags = 0;
+        if (function_exists('gzcompress')) {
+            $compressed = gzcompress($payload);
+            if (strlen($compressed) < strlen($payload)) {
+                $payload = $compressed;
+                $flags = self::BINARY_FLAG_ZLIB;
+            }
+        }
+        return self::BINARY_MAGIC . chr(self::BINARY_VERSION) . chr($flags) . $payload;
+    }
+
+    private static function _binaryEntry($prev, $id)
+    {
+        // Length of the common prefix: XOR of equal bytes is zero.
+        $shared = strspn($prev ^ $id, "\0");
+        return self::_varint($shared) . self::_varint(strlen($id) - $shared) . substr($id, $shared);
+    }
+
+    private static function _varint($n)
+    {
+        $s = "";
+        while ($n >= 0x80) {
+            $s .= chr(($n & 0x7F) | 0x80);
+            $n >>= 7;
+        }
+        return $s . chr($n);
+    }
+
     private function _log($msg, $dt)
     {
         if (!$this->_logger) {
@@ -99,11 +221,21 @@ class Zend_Cache_Backend_CacheLRUdWrapper implements Zend_Cache_Backend_Extended
             return;
         }
         $t0 = microtime(true);
-        fwrite($socket, $data);
+        $written = @fwrite($socket, $data);
+        if ($written !== strlen($data)) {
+            $this->_log(
+                sprintf(
+                    "failed to send packet with %d bytes to %s (%d bytes written)",
+                    strlen($data), $this->_getAddress(), $written === false? 0 : $written
+                ),
+                microtime(true) - $t0
+            );
+            return;
+        }
         $this->_log(
             sprintf(
-                "sending UDP packet with %d bytes to %s:%s",
-                strlen($data), $this->_host, $this->_port
+                "sending packet with %d bytes to %s",
+                strlen($data), $this->_getAddress()
             ),
             microtime(true) - $t0
         );
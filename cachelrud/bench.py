@@ -0,0 +1,343 @@
+import os
+import sys
+import time
+import errno
+import random
+import signal
+import socket
+import getopt
+import bisect
+import tempfile
+import threading
+import subprocess
+import protocol
+from storage.fake import PROBE_PREFIX
+from multiprocessing import Process, Queue
+
+MAX_MSG_SIZE = 10240  # as in CacheLRUdWrapper.php
+PROBE_INTERVAL = 0.01
+STARTUP_TIME = 2
+DRAIN_TIME = 5
+BENCH_SECTION = "bench"
+BENCH_SECTION_ID = 1
+
+
+def main():
+    """
+    Runs the daemon with a fake storage backend and sends it realistic
+    hit traffic, then prints what the daemon has managed to process.
+
+    :rtype: None
+    """
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", [
+            "help", "rate=", "duration=", "keys=", "zipf=", "hits-per-request=", "clients=",
+            "binary", "port=", "set=",
+        ])
+    except getopt.GetoptError as err:
+        print str(err)
+        return usage()
+    rate = 50000.0
+    duration = 10.0
+    num_keys = 100000
+    zipf = 1.0
+    hits_per_request = 20
+    num_clients = 1
+    binary = False
+    port = 45700
+    options = {
+        "touch_min_interval": "0",
+        "bucket_flush_max_time": "1",
+        "maxsize": "1G",
+        "fake_insert_rate": "1000",
+    }
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        elif o == "--rate":
+            rate = float(a)
+        elif o == "--duration":
+            duration = float(a)
+        elif o == "--keys":
+            num_keys = int(a)
+        elif o == "--zipf":
+            zipf = float(a)
+        elif o == "--hits-per-request":
+            hits_per_request = int(a)
+        elif o == "--clients":
+            num_clients = int(a)
+        elif o == "--binary":
+            binary = True
+        elif o == "--port":
+            port = int(a)
+        elif o == "--set":
+            name, value = a.split("=", 1)
+            options[name.strip()] = value.strip()
+
+    # Reports of the fake storage are collected in a background thread.
+    report_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    report_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024 * 1024)
+    report_sock.bind(("127.0.0.1", 0))
+    stats = Stats()
+    collector = threading.Thread(target=collect_reports, args=(report_sock, stats))
+    collector.daemon = True
+    collector.start()
+
+    options["dsn"] = "fake://127.0.0.1:%d/" % report_sock.getsockname()[1]
+    options["listenhost"] = "127.0.0.1"
+    options["listenport"] = str(port)
+    options["section_id"] = str(BENCH_SECTION_ID)
+    conf_fd, conf_path = tempfile.mkstemp(prefix="cachelrud-bench-", suffix=".conf")
+    log_path = conf_path[:-len(".conf")] + ".log"
+    with os.fdopen(conf_fd, "w") as f:
+        f.write("[DEFAULT]\ninclude =\nis_debug = 0\n")
+        f.write("[%s]\n" % BENCH_SECTION)
+        for name, value in sorted(options.items()):
+            f.write("%s = %s\n" % (name, value))
+    print "Config: %s, daemon log: %s" % (conf_path, log_path)
+    for name, value in sorted(options.items()):
+        print "    %s = %s" % (name, value)
+
+    daemon = subprocess.Popen(
+        [sys.executable, os.path.dirname(os.path.abspath(__file__)) + "/../bin/cachelrud", conf_path],
+        stdout=open(log_path, "w"), stderr=subprocess.STDOUT,
+        preexec_fn=os.setsid
+    )
+    try:
+        time.sleep(STARTUP_TIME)
+        if daemon.poll() is not None:
+            raise Exception("Daemon exited with code %d, see %s" % (daemon.returncode, log_path))
+        print "Generating %d keys/s for %d seconds: %d keys, zipf %.2f, %d hits per request, %d client(s), %s protocol" % (
+            rate, duration, num_keys, zipf, hits_per_request, num_clients, "binary" if binary else "text"
+        )
+        cdf = get_zipf_cdf(num_keys, zipf)
+        results = Queue()
+        stats.started_at = time.time()
+        clients = [
+            Process(target=run_client, args=(
+                i, ("127.0.0.1", port), rate / num_clients, duration, cdf, hits_per_request, binary, results
+            ))
+            for i in range(num_clients)
+        ]
+        for p in clients:
+            p.start()
+        sent_keys = 0
+        sent_datagrams = 0
+        probes = {}
+        for _ in clients:
+            keys, datagrams, client_probes = results.get()
+            sent_keys += keys
+            sent_datagrams += datagrams
+            probes.update(client_probes)
+        for p in clients:
+            p.join()
+        stats.finished_at = time.time()
+        print "Waiting %d seconds for the daemon to process the rest" % DRAIN_TIME
+        time.sleep(DRAIN_TIME)
+    finally:
+        try:
+            os.killpg(daemon.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        daemon.wait()
+    print_report(stats, sent_keys, sent_datagrams, probes)
+
+
+def usage():
+    """
+    :rtype: None
+    """
+    print "\n".join((
+        "Usage: " + sys.argv[0] + " [OPTION]...",
+        "Runs the daemon with a fake storage and measures its throughput.",
+        "    --rate=N              keys per second to send in total (default 50000)",
+        "    --duration=N          seconds to send for (default 10)",
+        "    --keys=N              number of distinct keys (default 100000)",
+        "    --zipf=S              Zipf distribution exponent of key hits (default 1.0)",
+        "    --hits-per-request=N  distinct keys packed together, like one PHP request does (default 20)",
+        "    --clients=N           number of sending processes (default 1)",
+        "    --binary              use binary protocol instead of text one",
+        "    --port=N              UDP port for the daemon (default 45700)",
+        "    --set=option=value    set a config option (e.g. bucket_size, updater_workers,",
+        "                          fake_touch_latency_ms, fake_reap_latency_ms), repeatable",
+    ))
+    sys.exit(1)
+
+
+class Stats(object):
+    """
+    Aggregated reports of the fake storage.
+    """
+
+    def __init__(self):
+        self.started_at = None
+        self.finished_at = None
+        self.touches = []  # (time, duration, number of keys)
+        self.reaps = []  # (time, duration, number of keys)
+        self.probes = {}  # probe key -> time when it was touched
+        self.lock = threading.Lock()
+
+    def window(self, events):
+        """
+        Returns events happened while clients were sending.
+
+        :type events: list[(float, float, int)]
+        :rtype: list[(float, float, int)]
+        """
+        with self.lock:
+            return [e for e in events if self.started_at <= e[0] <= self.finished_at]
+
+
+def collect_reports(sock, stats):
+    """
+    :type sock: socket.socket
+    :type stats: Stats
+    :rtype: None
+    """
+    while True:
+        try:
+            fields = sock.recv(65535).split(" ")
+        except socket.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        event = (float(fields[1]), float(fields[2]), int(fields[3]))
+        with stats.lock:
+            if fields[0] == "touch":
+                if event[2]:
+                    stats.touches.append(event)
+                for probe in fields[4:]:
+                    stats.probes.setdefault(probe, event[0])
+            elif fields[0] == "reap":
+                stats.reaps.append(event)
+
+
+def get_zipf_cdf(num_keys, s):
+    """
+    :type num_keys: int
+    :type s: float
+    :rtype: list[float]
+    """
+    cdf = []
+    total = 0.0
+    for rank in xrange(1, num_keys + 1):
+        total += 1.0 / rank ** s
+        cdf.append(total)
+    return [x / total for x in cdf]
+
+
+def run_client(client_id, addr, rate, duration, cdf, hits_per_request, binary, results):
+    """
+    Sends hits at the given rate. Keys of each simulated request are
+    deduplicated and packed into as few datagrams as possible, the same
+    way CacheLRUdWrapper::flushHits() does it. Unique probe keys are sent
+    every PROBE_INTERVAL seconds to measure the end-to-end latency and
+    the share of lost keys.
+
+    :type client_id: int
+    :type addr: (str, int)
+    :type rate: float
+    :type duration: float
+    :type cdf: list[float]
+    :type hits_per_request: int
+    :type binary: bool
+    :type results: Queue
+    :rtype: None
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rnd = random.Random(client_id)
+    num_keys = len(cdf)
+    sent_keys = 0
+    sent_datagrams = 0
+    probes = {}
+    probe_seq = 0
+    probe_at = 0
+    t0 = time.time()
+    deadline = t0 + duration
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        if now >= probe_at:
+            probe_at = now + PROBE_INTERVAL
+            probe = "%s%d:%d" % (PROBE_PREFIX, client_id, probe_seq)
+            probe_seq += 1
+            probes[probe] = now
+            sent_datagrams += send_keys(sock, addr, [probe], binary)
+        keys = set()
+        for _ in xrange(hits_per_request):
+            rank = min(bisect.bisect_left(cdf, rnd.random()), num_keys - 1)
+            keys.add("key:%d" % rank)
+        sent_datagrams += send_keys(sock, addr, list(keys), binary)
+        sent_keys += len(keys)
+        # Do not get ahead of the requested rate.
+        ahead = t0 + sent_keys / rate - time.time()
+        if ahead > 0:
+            time.sleep(ahead)
+    results.put((sent_keys, sent_datagrams, probes))
+
+
+def send_keys(sock, addr, keys, binary):
+    """
+    Returns the number of datagrams sent.
+
+    :type sock: socket.socket
+    :type addr: (str, int)
+    :type keys: list[str]
+    :type binary: bool
+    :rtype: int
+    """
+    if binary:
+        sock.sendto(protocol.encode([(BENCH_SECTION_ID, keys)], "zlib"), addr)
+        return 1
+    num = 0
+    lines = ""
+    for key in keys:
+        line = BENCH_SECTION + ":" + key + "\n"
+        if len(lines) + len(line) > MAX_MSG_SIZE:
+            sock.sendto(lines, addr)
+            num += 1
+            lines = ""
+        lines += line
+    if lines:
+        sock.sendto(lines, addr)
+        num += 1
+    return num
+
+
+def print_report(stats, sent_keys, sent_datagrams, probes):
+    """
+    :type stats: Stats
+    :type sent_keys: int
+    :type sent_datagrams: int
+    :type probes: dict[str, float]
+    :rtype: None
+    """
+    elapsed = stats.finished_at - stats.started_at
+    touches = stats.window(stats.touches)
+    touched_keys = sum(n for t, dt, n in touches)
+    reaps = stats.window(stats.reaps)
+    with stats.lock:
+        latencies = sorted(
+            stats.probes[probe] - sent_at
+            for probe, sent_at in probes.items()
+            if probe in stats.probes
+        )
+    lost = len(probes) - len(latencies)
+    print
+    print "Sent:             %d keys in %d datagrams, %d keys/s" % (sent_keys, sent_datagrams, sent_keys / elapsed)
+    print "Touched:          %d keys in %d calls, %d keys/s (same keys within a bucket are merged)" % (
+        touched_keys, len(touches), touched_keys / elapsed
+    )
+    if touches:
+        print "Touch call time:  %.1f ms average" % (sum(dt for t, dt, n in touches) / len(touches) * 1000)
+    print "Lost:             %d of %d probe keys (%.2f%%)" % (lost, len(probes), lost * 100.0 / max(len(probes), 1))
+    if latencies:
+        print "Latency:          p50 %d ms, p90 %d ms, p99 %d ms, max %d ms" % tuple(
+            latencies[min(int(len(latencies) * q), len(latencies) - 1)] * 1000
+            for q in (0.5, 0.9, 0.99, 1.0)
+        )
+    print "Reaper:           %d rounds, %.1f rounds/s, %d keys removed, %.1f ms per round" % (
+        len(reaps), len(reaps) / elapsed, sum(n for t, dt, n in reaps),
+        sum(dt for t, dt, n in reaps) / max(len(reaps), 1) * 1000
+    )
@@ -1,22 +1,69 @@
 import os
 import sys
-import socket
 import glob
 import time
 import re
+import zlib
+import socket
+import signal
+import logging
 import human_bytes
 import getopt
 import daemon_helper
+import socket_helper
+import protocol
+import metrics
+from shm_ring import ShmRing, Wakeup
+from touch_filter import TouchFilter
+from reaper_controller import RateController, StatEstimator, ReaperLease, plan_round
+from supervisor import Supervisor
+from profiling import SignalProfiler, SlowOperationLog
+from sketch import KeyStats
+from storage import POLICIES
 from ConfigParser import ConfigParser
-from multiprocessing.queues import Empty as QueueEmpty, Full as QueueFull
-from multiprocessing import Queue, Process
+from multiprocessing import Process
 
 ERROR_RECOVER_RECHECK_DT = 20
+RECONNECT_BACKOFF_MIN = 1
+RECONNECT_BACKOFF_MAX = 60
 PARENT_CHECK_TIMEOUT = 2
 CONFIGS = []
 DEFAULT_SECTION = "DEFAULT"
-UDP_BUF_SIZE = 10240
-UPDATER_QUEUE_MAX_SIZE = 1000
+# Maximum UDP payload: binary datagrams may be larger than text ones.
+UDP_BUF_SIZE = 65535
+UNIX_BUF_SIZE = 262144
+UDP_DROPS_CHECK_INTERVAL = 10
+JOURNAL_SYNC_INTERVAL = 1
+SPILL_CHECK_INTERVAL = 1
+# Spilled keys are replayed only while the updater keeps up with new ones.
+SPILL_REPLAY_MAX_USAGE = 0.5
+# A stopping updater exits when no keys arrive during this time, so the
+# buckets flushed by listeners stopped by the same signal are touched too.
+UPDATER_STOP_QUIET_TIME = 0.5
+CAPTURE_BUF_SIZE = 1024 * 1024
+REAPER_MODES = ("ids", "range", "sampled")
+LISTENER_OPTIONS = ("listener_rcvbuf", "listener_batch_size", "bucket_size", "bucket_flush_max_time")
+# Options used by one kind of processes only: changing them on reload does
+# not restart processes of other kinds. All "reaper_*" options are reaper
+# options too.
+LISTENER_ONLY_OPTIONS = LISTENER_OPTIONS + (
+    "listenhost", "listenport", "listener_workers", "listen_unix_path", "listen_unix_mode", "section_id",
+    "capture_dir", "sketch_top_keys", "sketch_window", "sketch_prefix_delimiter", "sketch_prefix_depth",
+)
+UPDATER_ONLY_OPTIONS = (
+    "updater_workers", "updater_ring_size", "journal_dir", "journal_spill_max_size", "touch_min_interval",
+    "touch_filter_max_keys", "touch_batch_size", "touch_batch_max_time", "touch_chunk_size", "touch_w",
+    "touch_max_in_flight",
+)
+REAPER_ONLY_OPTIONS = ("maxsize", "budget_group", "budget_group_maxsize")
+# Options of the watchdog itself, which are not applied on reload.
+WATCHDOG_OPTIONS = (
+    "include", "is_debug", "setuid", "log_type", "log_syslog_addr", "log_syslog_facility", "log_file_path",
+    "metrics_listen", "profile_dir", "profile_max_time",
+)
+RESTART_BACKOFF_MIN = 1
+RESTART_BACKOFF_MAX = 60
+RESTART_STABLE_TIME = 60
 
 check_parent_running_last_check_at = 0
 
@@ -52,10 +99,17 @@ def main():
             return usage("Unhandled option " + o)
 
     # Parse config.
-    conf = parse_config([
+    CONFIGS.extend([
         os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + "/..") + "/cachelrud.conf",
         opt_config
     ])
+    conf = parse_config(CONFIGS)
+    if not conf.sections():
+        usage("No sections found in config files " + ", ".join(CONFIGS))
+    try:
+        check_config(conf)
+    except Exception, e:
+        usage("Invalid config: %s" % str(e))
 
     # Deal with logging & daemon options.
     daemon_helper.set_process_name(opt_name)
@@ -66,7 +120,6 @@ def main():
         log_syslog_facility=conf.get(DEFAULT_SECTION, "log_syslog_facility"),
         log_file_path=conf.get(DEFAULT_SECTION, "log_file_path")
     )
-    import logging
     if opt_debug is not None or conf.getint(DEFAULT_SECTION, "is_debug"):
         log.setLevel(logging.DEBUG)
     else:
@@ -129,9 +182,6 @@ def parse_config(configs):
             conf.set(section, k, v)
 
     conf.remove_section(DEFAULT_SECTION)
-
-    if not conf.sections():
-        usage("No sections found in config files " + ", ".join(all_configs))
     return conf
 
 
@@ -155,223 +205,1069 @@ def loop_watchdog(log, conf):
     :type conf: ConfigParser
     :rtype: None
     """
-    updater_queue = Queue(UPDATER_QUEUE_MAX_SIZE)
-    listeners = {}
-    updater = None
-    reaper = None
+    listener_specs = get_listener_specs(conf)
+    updater_wakeups, updater_rings = create_updater_rings(conf, listener_specs)
+    child_specs = get_child_specs(conf, listener_specs)
+    supervisor = Supervisor(log, RESTART_BACKOFF_MIN, RESTART_BACKOFF_MAX, RESTART_STABLE_TIME)
+    # Metrics blocks outlive restarts of their processes, so counters keep
+    # growing monotonically.
+    child_metrics = {}
+    metrics_sock = None
+    metrics_listen = conf.get(DEFAULT_SECTION, "metrics_listen")
+    if metrics_listen:
+        log.info("Serving metrics at http://%s/metrics", metrics_listen)
+        metrics_sock = metrics.create_http_socket(metrics_listen)
+    # Children inherit this handler too, so SIGHUP sent to the whole
+    # process group does not kill them.
+    reload_signals = []
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_signals.append(signum))
+    # SIGUSR1 toggles profiling of children (see SignalProfiler), it must
+    # not kill the watchdog when sent to the whole process group.
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    # SIGUSR2 makes listeners log key popularity stats (see KeyStats).
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    # On SIGTERM children are stopped in order, like on reload, so keys
+    # flushed by listeners are touched before updaters exit. Listeners and
+    # updaters install their own handlers, reapers restore the default one.
+    stop_signals = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_signals.append(signum))
+    profiler = SignalProfiler(conf.get(DEFAULT_SECTION, "profile_dir"), conf.getfloat(DEFAULT_SECTION, "profile_max_time"))
 
     log.info("Running watchdog loop")
     while True:
+        if stop_signals:
+            log.info("Stopping all children")
+            for kind in ("listener", "updater", "reaper"):
+                stop_processes(log, supervisor.processes([name for name in child_specs if name.startswith(kind)]))
+            log.info("Exiting")
+            return
+
         try:
-            # If somebody dies, respawn all processes.
-            if len(filter(lambda l: not l.is_alive(), listeners.values())) or (updater is not None and not updater.is_alive()):
-                # We have to kill everybody, because else Queue does not work (deadlock).
-                log.warning("Some of child processes died unexpectedly, respawning everybody.")
-                for l in listeners.values():
-                    l.terminate()
-                if updater is not None:
-                    updater.terminate()
-                updater_queue = Queue(UPDATER_QUEUE_MAX_SIZE)
-                listeners = {}
-                updater = None
+            if reload_signals:
+                del reload_signals[:]
+                new_conf = reload_config(log)
+                if new_conf is not None:
+                    new_listener_specs = get_listener_specs(new_conf)
+                    new_child_specs = get_child_specs(new_conf, new_listener_specs)
+                    # Listeners go first: they flush their buckets into the
+                    # rings, and then stopping updaters touch everything left.
+                    for kind in ("listener", "updater", "reaper"):
+                        names = [
+                            name for name, spec in child_specs.items()
+                            if name.startswith(kind) and new_child_specs.get(name) != spec
+                        ]
+                        if names:
+                            log.info("Stopping changed or removed children: %s", ", ".join(sorted(names)))
+                            stop_processes(log, supervisor.processes(names))
+                            for name in names:
+                                supervisor.forget(name)
+                                child_metrics.pop(name, None)
+                    updater_wakeups, updater_rings = create_updater_rings(
+                        new_conf, new_listener_specs, conf, updater_wakeups, updater_rings
+                    )
+                    conf, listener_specs, child_specs = new_conf, new_listener_specs, new_child_specs
+
+            # Each child is restarted alone: rings survive, and a process
+            # killed in the middle of a write or a read never leaves a ring
+            # inconsistent, so a new updater continues with the keys the old
+            # one did not process, and other processes do not even notice.
+            for key, (section, listenhost, listenport, reuseport, unix_sockets) in listener_specs.items():
+                name = "listener for " + key
+                if name not in child_metrics:
+                    child_metrics[name] = create_listener_metrics(conf, key)
+                supervisor.ensure(name, lambda: Process(target=daemon_helper.exceptions_to_log(log, loop_listener), args=(
+                    log.getChild("listener"),
+                    listenhost, listenport,
+                    reuseport,
+                    unix_sockets,
+                    human_bytes.human2bytes(conf.get(section, 'listener_rcvbuf')),
+                    conf.getint(section, 'listener_batch_size'),
+                    updater_rings[key],
+                    get_section_ids(conf),
+                    conf.getint(section, 'bucket_size'),
+                    conf.getint(section, 'bucket_flush_max_time'),
+                    get_capture_paths(conf, key),
+                    child_metrics[name],
+                    profiler,
+                    create_key_stats(conf)
+                )))
 
             for section in conf.sections():
-                # Respawn listeners.
-                listenhost = conf.get(section, "listenhost")
-                listenport = conf.getint(section, "listenport")
-                key = listenhost + ":" + str(listenport)
-                if key not in listeners:
-                    listeners[key] = Process(target=daemon_helper.exceptions_to_log(log, loop_listener), args=(
-                        log.getChild("listener"),
-                        listenhost, listenport,
-                        updater_queue,
-                        conf.sections(),
-                        conf.getint(section, 'bucket_size'),
-                        conf.getint(section, 'bucket_flush_max_time')
-                    ))
-                    listeners[key].start()
-                    log.info("Spawned a new listener for %s:%d: pid=%d", listenhost, listenport, listeners[key].pid)
-
-                # Respawn updater.
-                if updater is None:
-                    updater = Process(target=daemon_helper.exceptions_to_log(log, loop_updater), args=(
+                for worker, updater_wakeup in enumerate(updater_wakeups[section]):
+                    name = "updater for %s#%d" % (section, worker)
+                    if name not in child_metrics:
+                        child_metrics[name] = create_updater_metrics(section, worker)
+                    supervisor.ensure(name, lambda: Process(target=daemon_helper.exceptions_to_log(log, loop_updater), args=(
                         log.getChild("updater"),
                         conf,
-                        updater_queue,
-                    ))
-                    updater.start()
-                    log.info("Spawned a new updater: pid=%d", updater.pid)
-
-                # Respawn reaper.
-                if reaper is None or not reaper.is_alive():
-                    if reaper is not None:
-                        log.warning("Reaper %d died unexpectedly, respawning.", reaper.pid)
-                    reaper = Process(target=daemon_helper.exceptions_to_log(log, loop_reaper), args=(
-                        log.getChild("reaper"),
-                        conf,
-                    ))
-                    reaper.start()
-                    log.info("Spawned a new reaper: pid=%d", reaper.pid)
+                        section,
+                        [rings[section][worker] for rings in updater_rings.values()],
+                        updater_wakeup,
+                        child_metrics[name],
+                        profiler,
+                    )))
+
+            # One reaper per budget group (or section without a group), so
+            # a changed section does not reset reapers of other ones.
+            for group, sections in get_reaper_groups(conf):
+                name = "reaper for " + group
+                if name not in child_metrics:
+                    child_metrics[name] = create_reaper_metrics(sections)
+                supervisor.ensure(name, lambda: Process(target=daemon_helper.exceptions_to_log(log, loop_reaper), args=(
+                    log.getChild("reaper"),
+                    conf,
+                    [(group, sections)],
+                    child_metrics[name],
+                    profiler,
+                )))
 
         except Exception, e:
             log.error("%s: %s", str(e.__class__.__name__), str(e))
-        time.sleep(1)
+
+        # Sleep, answering metrics requests meanwhile.
+        if metrics_sock is None:
+            time.sleep(1)
+        elif socket_helper.wait_readable([metrics_sock], 1):
+            try:
+                metrics.serve_http(metrics_sock, lambda: render_metrics(conf, child_metrics, updater_rings))
+            except Exception, e:
+                log.error("Metrics: %s: %s", str(e.__class__.__name__), str(e))
+
+
+def create_listener_metrics(conf, listener_key):
+    """
+    :type conf: ConfigParser
+    :type listener_key: str
+    :rtype: metrics.SharedMetrics
+    """
+    specs = [
+        (metrics.COUNTER, "cachelrud_listener_parse_errors_total", "", ()),
+        (metrics.COUNTER, "cachelrud_listener_unknown_sections_total", "", ()),
+        (metrics.GAUGE, "cachelrud_listener_kernel_drops", "", ()),
+    ]
+    for section in conf.sections():
+        labels = metrics.format_labels([("section", section)])
+        for name in (
+            "cachelrud_listener_datagrams_total",
+            "cachelrud_listener_keys_total",
+            "cachelrud_listener_bucket_flushes_total",
+            "cachelrud_listener_discarded_keys_total",
+            "cachelrud_listener_spilled_keys_total",
+        ):
+            specs.append((metrics.COUNTER, name, labels, ()))
+        specs.append((metrics.GAUGE, "cachelrud_listener_distinct_keys", labels, ()))
+    return metrics.SharedMetrics(metrics.format_labels([("listener", listener_key)]), specs)
+
+
+def create_updater_metrics(section, worker):
+    """
+    :type section: str
+    :type worker: int
+    :rtype: metrics.SharedMetrics
+    """
+    return metrics.SharedMetrics(metrics.format_labels([("section", section), ("worker", worker)]), [
+        (metrics.COUNTER, "cachelrud_updater_keys_received_total", "", ()),
+        (metrics.COUNTER, "cachelrud_updater_keys_replayed_total", "", ()),
+        (metrics.COUNTER, "cachelrud_updater_keys_skipped_total", "", ()),
+        (metrics.COUNTER, "cachelrud_updater_keys_touched_total", "", ()),
+        (metrics.HISTOGRAM, "cachelrud_updater_touch_duration_seconds", "", metrics.LATENCY_BUCKETS),
+        (metrics.HISTOGRAM, "cachelrud_updater_batch_latency_seconds", "", metrics.LATENCY_BUCKETS),
+    ])
+
+
+def create_reaper_metrics(sections):
+    """
+    :type sections: list[str]
+    :rtype: metrics.SharedMetrics
+    """
+    specs = []
+    for section in sections:
+        labels = metrics.format_labels([("section", section)])
+        specs.extend([
+            (metrics.COUNTER, "cachelrud_reaper_rounds_total", labels, ()),
+            (metrics.COUNTER, "cachelrud_reaper_keys_removed_total", labels, ()),
+            (metrics.COUNTER, "cachelrud_reaper_bytes_removed_total", labels, ()),
+            (metrics.COUNTER, "cachelrud_reaper_errors_total", labels, ()),
+            (metrics.HISTOGRAM, "cachelrud_reaper_round_keys", labels, metrics.ROUND_SIZE_BUCKETS),
+            (metrics.HISTOGRAM, "cachelrud_reaper_delete_duration_seconds", labels, metrics.LATENCY_BUCKETS),
+            (metrics.GAUGE, "cachelrud_collection_size_bytes", labels, ()),
+            (metrics.GAUGE, "cachelrud_collection_keys", labels, ()),
+        ])
+    return metrics.SharedMetrics("", specs)
+
+
+def render_metrics(conf, child_metrics, updater_rings):
+    """
+    Returns metrics of all child processes, usage of rings between them
+    and size limits of the sections (budget_group_maxsize for sections in
+    a budget group) in Prometheus text format.
+
+    :type conf: ConfigParser
+    :type child_metrics: dict[str, metrics.SharedMetrics]
+    :type updater_rings: dict[str, dict[str, list[ShmRing]]]
+    :rtype: str
+    """
+    samples = []
+    for block in child_metrics.values():
+        samples.extend(block.samples())
+    for key, section_rings in updater_rings.items():
+        for section, rings in section_rings.items():
+            for worker, ring in enumerate(rings):
+                labels = metrics.format_labels([("listener", key), ("section", section), ("worker", worker)])
+                samples.append((metrics.GAUGE, "cachelrud_ring_usage_ratio", [
+                    metrics.format_sample("cachelrud_ring_usage_ratio", labels, ring.usage())
+                ]))
+    for section in conf.sections():
+        samples.append((metrics.GAUGE, "cachelrud_collection_maxsize_bytes", [metrics.format_sample(
+            "cachelrud_collection_maxsize_bytes",
+            metrics.format_labels([("section", section)]),
+            get_maxsize(conf, section)
+        )]))
+    return metrics.render(samples)
+
+
+def reload_config(log):
+    """
+    Re-reads config files. Returns None (so the current config is kept)
+    if they cannot be parsed.
+
+    :type log: logging.Logger
+    :rtype: ConfigParser|None
+    """
+    log.info("Reloading config files %s", ", ".join(CONFIGS))
+    try:
+        conf = parse_config(CONFIGS)
+    except Exception, e:
+        log.error("Config is not reloaded: %s: %s", e.__class__.__name__, str(e))
+        return None
+    if not conf.sections():
+        log.error("Config is not reloaded: no sections found in config files %s", ", ".join(CONFIGS))
+        return None
+    try:
+        check_config(conf)
+    except Exception, e:
+        log.error("Config is not reloaded: %s", str(e))
+        return None
+    return conf
+
+
+def check_config(conf):
+    """
+    Raises an exception if settings of a section are not supported, so a
+    bad config is rejected at startup or reload instead of crashing a
+    child process in a loop.
+
+    :type conf: ConfigParser
+    :rtype: None
+    """
+    get_section_ids(conf)
+    for section in conf.sections():
+        policy = conf.get(section, 'eviction_policy')
+        if policy not in POLICIES:
+            raise Exception("[%s] unknown eviction_policy '%s', allowed: %s" % (section, policy, ", ".join(POLICIES)))
+        reaper_mode = conf.get(section, 'reaper_mode')
+        if reaper_mode not in REAPER_MODES:
+            raise Exception("[%s] unknown reaper_mode '%s', allowed: %s" % (section, reaper_mode, ", ".join(REAPER_MODES)))
+        if conf.getint(section, 'reaper_size_aware') and reaper_mode != "ids":
+            raise Exception("[%s] reaper_size_aware is supported in reaper_mode=ids only" % section)
+        if reaper_mode == "range" and policy != "lru":
+            raise Exception("[%s] reaper_mode=range supports eviction_policy=lru only" % section)
+        if reaper_mode == "range" and conf.getint(section, 'reaper_partitioned'):
+            raise Exception("[%s] reaper_partitioned is not supported in reaper_mode=range" % section)
+
+
+def get_child_specs(conf, listener_specs):
+    """
+    Returns everything each child process is started with. On reload, only
+    the children whose specs differ are restarted (so e.g. an updater does
+    not reconnect to its database when another section or an option of
+    listeners or reapers is changed).
+
+    :type conf: ConfigParser
+    :type listener_specs: dict[str, (str, str, int, bool, tuple)]
+    :rtype: dict[str, tuple]
+    """
+    ring_specs = tuple((section, get_ring_spec(conf, section)) for section in sorted(conf.sections()))
+    specs = {}
+    for key, (section, listenhost, listenport, reuseport, unix_sockets) in listener_specs.items():
+        specs["listener for " + key] = (
+            listenhost, listenport, reuseport, unix_sockets,
+            tuple(conf.get(section, k) for k in LISTENER_OPTIONS),
+            ring_specs,
+            tuple(sorted(get_section_ids(conf).items())),
+            tuple(sorted(get_capture_paths(conf, key).items())),
+            tuple(sorted(get_sketch_specs(conf).items())),
+        )
+    for section in conf.sections():
+        ring_spec = get_ring_spec(conf, section)
+        for worker in range(ring_spec[0]):
+            specs["updater for %s#%d" % (section, worker)] = (
+                get_options_spec(conf, section, lambda k: (
+                    k in LISTENER_ONLY_OPTIONS or k in REAPER_ONLY_OPTIONS or k.startswith("reaper_")
+                )),
+                ring_spec,
+                tuple(sorted(listener_specs)),
+            )
+    for group, sections in get_reaper_groups(conf):
+        specs["reaper for " + group] = tuple(
+            (section, get_options_spec(conf, section, lambda k: k in LISTENER_ONLY_OPTIONS or k in UPDATER_ONLY_OPTIONS))
+            for section in sections
+        )
+    return specs
+
+
+def get_options_spec(conf, section, unused):
+    """
+    Returns options of the section which a process depends on: all except
+    the watchdog's ones and the ones for which unused(name) is True.
+
+    :type conf: ConfigParser
+    :type section: str
+    :type unused: callable
+    :rtype: tuple
+    """
+    return tuple((k, v) for k, v in sorted(conf.items(section)) if k not in WATCHDOG_OPTIONS and not unused(k))
+
+
+def get_section_ids(conf):
+    """
+    Returns sections which binary protocol datagrams may address, by their
+    section_id option.
+
+    :type conf: ConfigParser
+    :rtype: dict[int, str]
+    """
+    section_ids = {}
+    for section in conf.sections():
+        value = conf.get(section, "section_id")
+        if not value:
+            continue
+        section_id = int(value)
+        if not 0 <= section_id <= 255:
+            raise Exception("section_id of [%s] must be in 0..255, but %d given" % (section, section_id))
+        if section_id in section_ids:
+            raise Exception("section_id %d is used by both [%s] and [%s]" % (section_id, section_ids[section_id], section))
+        section_ids[section_id] = section
+    return section_ids
+
+
+def get_listener_specs(conf):
+    """
+    Returns listener processes to be run: listener_workers processes for
+    each distinct listenhost:listenport. Parameters of a listener are taken
+    from the first section which mentions its listenhost:listenport. The
+    first worker also binds unix sockets (path and mode) of all sections
+    which mention its listenhost:listenport.
+
+    :type conf: ConfigParser
+    :rtype: dict[str, (str, str, int, bool, tuple)]
+    """
+    specs = {}
+    unix_sockets = {}
+    for section in conf.sections():
+        listenhost = conf.get(section, "listenhost")
+        listenport = conf.getint(section, "listenport")
+        listener_workers = max(conf.getint(section, "listener_workers"), 1)
+        for worker in range(listener_workers):
+            key = "%s:%d#%d" % (listenhost, listenport, worker)
+            if key not in specs:
+                specs[key] = (section, listenhost, listenport, listener_workers > 1)
+                unix_sockets[key] = []
+        path = conf.get(section, "listen_unix_path")
+        key = "%s:%d#0" % (listenhost, listenport)
+        if path and path not in [p for p, _ in unix_sockets[key]]:
+            unix_sockets[key].append((path, int(conf.get(section, "listen_unix_mode"), 8)))
+    return {key: spec + (tuple(unix_sockets[key]),) for key, spec in specs.items()}
+
+
+def create_updater_rings(conf, listener_specs, old_conf=None, old_wakeups=None, old_rings=None):
+    """
+    Creates a separate ring for each listener process and each updater
+    worker (updater_workers of them for each section), so every ring has
+    exactly one writer and one reader. Updater worker N of a section reads
+    keys from the Nth ring of that section of each listener. A wakeup per
+    updater worker is notified when any of its rings is written.
+
+    On reload, rings (with the keys not processed yet) and wakeups of the
+    sections whose ring parameters are not changed are reused. Processes
+    using the other ones must be stopped before this call.
+
+    :type conf: ConfigParser
+    :type listener_specs: dict[str, (str, str, int, bool, tuple)]
+    :type old_conf: ConfigParser|None
+    :type old_wakeups: dict[str, list[Wakeup]]|None
+    :type old_rings: dict[str, dict[str, list[ShmRing]]]|None
+    :rtype: (dict[str, list[Wakeup]], dict[str, dict[str, list[ShmRing]]])
+    """
+    reusable = set()
+    if old_conf is not None:
+        reusable = set(
+            section for section in conf.sections()
+            if old_conf.has_section(section) and get_ring_spec(old_conf, section) == get_ring_spec(conf, section)
+        )
+    wakeups = {
+        section: old_wakeups[section] if section in reusable else [Wakeup() for _ in range(get_ring_spec(conf, section)[0])]
+        for section in conf.sections()
+    }
+    rings = {
+        key: {
+            section: old_rings[key][section] if section in reusable and key in old_rings else [
+                ShmRing(
+                    human_bytes.human2bytes(conf.get(section, "updater_ring_size")),
+                    wakeup,
+                    get_journal_path(conf, section, worker, key),
+                    human_bytes.human2bytes(conf.get(section, "journal_spill_max_size"))
+                )
+                for worker, wakeup in enumerate(wakeups[section])
+            ]
+            for section in conf.sections()
+        }
+        for key in listener_specs
+    }
+    return wakeups, rings
+
+
+def get_ring_spec(conf, section):
+    """
+    Returns parameters of a section's rings: the number of updater
+    workers, the ring size, the journal directory and the spill limit.
+
+    :type conf: ConfigParser
+    :type section: str
+    :rtype: (int, str, str, str)
+    """
+    return (
+        max(conf.getint(section, "updater_workers"), 1),
+        conf.get(section, "updater_ring_size"),
+        conf.get(section, "journal_dir"),
+        conf.get(section, "journal_spill_max_size"),
+    )
+
+
+def get_journal_path(conf, section, worker, listener_key):
+    """
+    Returns a file to back a ring with (so unprocessed keys survive daemon
+    restarts) or None if journal_dir is not configured.
+
+    :type conf: ConfigParser
+    :type section: str
+    :type worker: int
+    :type listener_key: str
+    :rtype: str|None
+    """
+    journal_dir = conf.get(section, "journal_dir")
+    if not journal_dir:
+        return None
+    name = "%s.%d.%s.ring" % (section, worker, listener_key)
+    return os.path.join(journal_dir, re.sub(r'[^\w.#-]', '_', name))
+
+
+def get_capture_paths(conf, listener_key):
+    """
+    Returns files a listener appends received hits of each section to (for
+    bin/cachelrud-simulate), for sections with capture_dir configured.
+
+    :type conf: ConfigParser
+    :type listener_key: str
+    :rtype: dict[str, str]
+    """
+    paths = {}
+    for section in conf.sections():
+        capture_dir = conf.get(section, "capture_dir")
+        if capture_dir:
+            name = "%s.%s.trace" % (section, listener_key)
+            paths[section] = os.path.join(capture_dir, re.sub(r'[^\w.#-]', '_', name))
+    return paths
 
 
-def loop_listener(log, listenhost, listenport, updater_queue, allowed_sections, bucket_size, bucket_flush_max_time):
+def get_sketch_specs(conf):
+    """
+    Returns parameters of key popularity stats of sections where they are
+    enabled: the number of top keys, the window, the prefix delimiter and
+    the prefix depth.
+
+    :type conf: ConfigParser
+    :rtype: dict[str, (int, float, str, int)]
+    """
+    specs = {}
+    for section in conf.sections():
+        top_keys = conf.getint(section, "sketch_top_keys")
+        if top_keys > 0:
+            specs[section] = (
+                top_keys,
+                conf.getfloat(section, "sketch_window"),
+                conf.get(section, "sketch_prefix_delimiter"),
+                max(conf.getint(section, "sketch_prefix_depth"), 1),
+            )
+    return specs
+
+
+def create_key_stats(conf):
+    """
+    :type conf: ConfigParser
+    :rtype: dict[str, KeyStats]
+    """
+    return {section: KeyStats(*spec) for section, spec in get_sketch_specs(conf).items()}
+
+
+def stop_processes(log, processes):
+    """
+    Asks processes to finish (so listeners flush their buckets) and kills
+    the ones which do not finish in time. A ring must never have two
+    writers, so new listeners are not started until old ones are gone.
+
+    :type log: logging.Logger
+    :type processes: list[Process]
+    :rtype: None
+    """
+    for p in processes:
+        if p.is_alive():
+            p.terminate()
+    deadline = time.time() + PARENT_CHECK_TIMEOUT
+    for p in processes:
+        p.join(max(deadline - time.time(), 0))
+        if p.is_alive():
+            log.warning("Process %d did not finish in time, killing it", p.pid)
+            os.kill(p.pid, signal.SIGKILL)
+            p.join()
+
+
+def shard_keys(keys, num_shards):
+    """
+    Splits keys into num_shards lists, so the same key always lands
+    into the same shard (in any process).
+
+    :type keys: list[str]
+    :type num_shards: int
+    :rtype: list[list[str]]
+    """
+    if num_shards == 1:
+        return [keys]
+    shards = [[] for _ in range(num_shards)]
+    for key in keys:
+        shards[(zlib.crc32(key) & 0xffffffff) % num_shards].append(key)
+    return shards
+
+
+def loop_listener(log, listenhost, listenport, reuseport, unix_sockets, rcvbuf, batch_size, updater_rings, section_ids, bucket_size, bucket_flush_max_time, capture_paths, listener_metrics, profiler, key_stats):
     """
     :type log: logging.Logger
     :type listenhost: str
     :type listenport: int
-    :type updater_queue: Queue
-    :type allowed_sections: list
+    :type reuseport: bool
+    :type unix_sockets: tuple[(str, int)]
+    :type rcvbuf: int
+    :type batch_size: int
+    :type updater_rings: dict[str, list[ShmRing]]
+    :type section_ids: dict[int, str]
     :type bucket_size: int
+    :type bucket_flush_max_time: int
+    :type capture_paths: dict[str, str]
+    :type listener_metrics: metrics.SharedMetrics
+    :type profiler: SignalProfiler
+    :type key_stats: dict[str, KeyStats]
     :rtype: None
     """
     daemon_helper.set_process_name(log.name)
     ppid = os.getppid()
+    profiler.install(log)
+    dump_signals = []
+    signal.signal(signal.SIGUSR2, lambda signum, frame: dump_signals.append(signum))
     log.info("Listening at %s:%d", listenhost, listenport)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind((listenhost if listenhost != "*" else "0.0.0.0", listenport))
-    sock.settimeout(PARENT_CHECK_TIMEOUT)
+    sock = socket_helper.create_udp_socket(listenhost, listenport, rcvbuf, reuseport)
+    # Unix sockets deliver datagrams much larger than UDP ones.
+    buf_sizes = {sock: UDP_BUF_SIZE}
+    for path, mode in unix_sockets:
+        log.info("Listening at %s", path)
+        buf_sizes[socket_helper.create_unix_socket(path, mode, rcvbuf)] = UNIX_BUF_SIZE
+    socks = buf_sizes.keys()
+    allowed_sections = updater_rings.keys()
+    sections = frozenset(allowed_sections)
     buckets = {k: {} for k in allowed_sections}
+    section_labels = {k: metrics.format_labels([("section", k)]) for k in allowed_sections}
+    captures = {}
+    for section, path in capture_paths.items():
+        log.info("Capturing hits of [%s] to %s", section, path)
+        captures[section] = open(path, "a", CAPTURE_BUF_SIZE)
+    # Building debug message arguments per datagram is not free.
+    is_debug = log.isEnabledFor(logging.DEBUG)
     last_queue_put_at = time.time()
+    drops = socket_helper.get_udp_drops(sock)
+    drops_checked_at = time.time()
+    synced_at = time.time()
+    # Do not lose buckets on termination by the watchdog: flush them first.
+    stop_signals = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_signals.append(signum))
 
     def flush_buckets(sec):
         bucket = buckets[sec]
         if not bucket:
             return
-        try:
-            log.debug("Flushing %d keys to updater. Queue size before: %d", len(bucket), updater_queue.qsize())
-            updater_queue.put_nowait((sec, bucket.keys()))
-        except QueueFull:
-            log.error("Queue is full, possibly updater process is dead?")
-            log.error("Because of that all keys (%d) are discarded.", len(bucket))
+        if sec in key_stats:
+            # Distinct counting does not need duplicates: take them deduplicated.
+            key_stats[sec].add_distinct(bucket.keys(), time.time())
+        rings = updater_rings[sec]
+        for worker, keys in enumerate(shard_keys(bucket.keys(), len(rings))):
+            if not keys:
+                continue
+            log.debug("Flushing %d keys to updater %s#%d. Ring usage before: %d%%", len(keys), sec, worker, rings[worker].usage() * 100)
+            discarded = rings[worker].write(keys)
+            if discarded and rings[worker].spill is not None:
+                # Delay the keys which do not fit instead of losing them.
+                spilled = discarded - rings[worker].spill.append(keys[len(keys) - discarded:])
+                if spilled:
+                    log.warning("Ring %s#%d is full, %d of %d keys are spilled to the journal", sec, worker, spilled, len(keys))
+                    listener_metrics.inc("cachelrud_listener_spilled_keys_total", section_labels[sec], spilled)
+                discarded -= spilled
+            if discarded:
+                log.error("Ring %s#%d is full, possibly updater process is dead or too slow?", sec, worker)
+                log.error("Because of that %d of %d keys are discarded.", discarded, len(keys))
+                listener_metrics.inc("cachelrud_listener_discarded_keys_total", section_labels[sec], discarded)
+        listener_metrics.inc("cachelrud_listener_bucket_flushes_total", section_labels[sec])
         buckets[sec] = {}
 
     while True:
-        if not check_parent_running(log, ppid):
+        profiler.check()
+        if dump_signals:
+            del dump_signals[:]
+            for section, stats in sorted(key_stats.items()):
+                log.info("Key stats of [%s]:\n%s", section, "\n".join(stats.report(time.time())))
+        if stop_signals or not check_parent_running(log, ppid):
+            log.info("Flushing all buckets before exit")
+            for section in allowed_sections:
+                flush_buckets(section)
+            for rings in updater_rings.values():
+                for ring in rings:
+                    ring.sync()
+            for f in captures.values():
+                f.close()
+            for path, mode in unix_sockets:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            profiler.stop()
             return
 
-        try:
-            data, addr = sock.recvfrom(UDP_BUF_SIZE)
-        except socket.timeout:
-            # In loaded systems this never happens: there are always pending messages.
-            if time.time() > last_queue_put_at + bucket_flush_max_time:
-                last_queue_put_at = time.time()
-                for section in allowed_sections:
-                    flush_buckets(section)
-            continue
+        # Sleep until at least one datagram arrives, then drain sockets
+        # without blocking to save on syscalls and wakeups.
+        datagrams = []
+        for ready in socket_helper.wait_readable(socks, PARENT_CHECK_TIMEOUT):
+            datagrams.extend(socket_helper.recv_batch(ready, buf_sizes[ready], batch_size))
 
-        if not data:
-            continue
+        now = time.time()
+        if now > synced_at + JOURNAL_SYNC_INTERVAL:
+            synced_at = now
+            for rings in updater_rings.values():
+                for ring in rings:
+                    ring.sync()
+            for f in captures.values():
+                f.flush()
+        if now > drops_checked_at + UDP_DROPS_CHECK_INTERVAL:
+            drops_checked_at = now
+            new_drops = socket_helper.get_udp_drops(sock)
+            if new_drops is not None:
+                listener_metrics.set("cachelrud_listener_kernel_drops", "", new_drops)
+            if drops is not None and new_drops > drops:
+                log.warning(
+                    "Kernel dropped %d datagram(s) in the last %d seconds (%d total), consider increasing listener_rcvbuf or listener_workers",
+                    new_drops - drops, UDP_DROPS_CHECK_INTERVAL, new_drops
+                )
+            drops = new_drops
+            for section, stats in key_stats.items():
+                listener_metrics.set("cachelrud_listener_distinct_keys", section_labels[section], stats.last_distinct())
 
-        lines = data.split("\n")
-        log.debug("Received a datagram from %s:%s with %d bytes, %d key(s)", addr[0], addr[1], len(data), len(lines))
-        for line in lines:
-            line = line.strip()
-            if not line:
+        # Checked on every wakeup, not only on idle timeouts: with several
+        # sections one busy section must not delay flushing the others.
+        if now > last_queue_put_at + bucket_flush_max_time:
+            last_queue_put_at = now
+            for section in allowed_sections:
+                flush_buckets(section)
+
+        for data in datagrams:
+            if not data:
                 continue
-            #log.debug("<-- %s", line)
-            try:
-                section, key = line.split(":", 1)
-                if section not in allowed_sections:
-                    log.warning("Unknown section name: '%s'", section)
+            if protocol.is_binary(data):
+                try:
+                    blocks = protocol.decode(data)
+                except protocol.ProtocolError, e:
+                    log.info("Malformed binary datagram with %d bytes received: %s", len(data), str(e))
+                    listener_metrics.inc("cachelrud_listener_parse_errors_total", "")
                     continue
-                buckets[section][key] = 1
-                if len(buckets[section]) >= bucket_size:
+                batches = {}
+                for section_id, keys in blocks:
+                    section = section_ids.get(section_id)
+                    if section is None:
+                        log.warning("Unknown section id: %d", section_id)
+                        listener_metrics.inc("cachelrud_listener_unknown_sections_total", "")
+                        continue
+                    batches.setdefault(section, []).extend(keys)
+            else:
+                batches, unknown, malformed = protocol.parse_text(data, sections)
+                for section in unknown:
+                    log.warning("Unknown section name: '%s'", section)
+                    listener_metrics.inc("cachelrud_listener_unknown_sections_total", "")
+                for line in malformed:
+                    log.info("Message should have format 'section_name:id', but '%s' received", line)
+                    listener_metrics.inc("cachelrud_listener_parse_errors_total", "")
+            if is_debug:
+                log.debug("Received a datagram with %d bytes, %d key(s)", len(data), sum(len(keys) for keys in batches.values()))
+            if captures:
+                capture_batches(captures, batches, "%.3f\t" % now)
+            if key_stats:
+                for section, keys in batches.iteritems():
+                    if section in key_stats:
+                        key_stats[section].add_hits(keys, now)
+            for section, keys in batches.iteritems():
+                listener_metrics.inc("cachelrud_listener_datagrams_total", section_labels[section])
+                listener_metrics.inc("cachelrud_listener_keys_total", section_labels[section], len(keys))
+                bucket = buckets[section]
+                bucket.update(dict.fromkeys(keys, 1))
+                if len(bucket) >= bucket_size:
                     last_queue_put_at = time.time()
                     flush_buckets(section)
-            except ValueError:
-                log.info("Message should have format 'section_name:id', but '%s' received", line)
 
 
-def loop_updater(log, conf, updater_queue):
+def capture_batches(captures, batches, prefix):
+    """
+    Appends received keys to capture files as "time<TAB>key" lines.
+
+    :type captures: dict[str, file]
+    :type batches: dict[str, list[str]]
+    :type prefix: str
+    :rtype: None
+    """
+    for section, keys in batches.iteritems():
+        f = captures.get(section)
+        if f is not None and keys:
+            f.write(prefix + ("\n" + prefix).join(keys) + "\n")
+
+
+def loop_updater(log, conf, section, updater_rings, updater_wakeup, updater_metrics, profiler):
     """
     :type log: logging.Logger
     :type conf: ConfigParser
-    :type updater_queue: Queue
+    :type section: str
+    :type updater_rings: list[ShmRing]
+    :type updater_wakeup: Wakeup
+    :type updater_metrics: metrics.SharedMetrics
+    :type profiler: SignalProfiler
     :rtype: None
     """
     daemon_helper.set_process_name(log.name)
     ppid = os.getppid()
-    storages = {}
+    profiler.install(log)
+    log_section = log.getChild(section)
+    storage = None
+    touch_filter = TouchFilter(
+        conf.getfloat(section, 'touch_min_interval'),
+        conf.getint(section, 'touch_filter_max_keys')
+    )
+    batch_size = conf.getint(section, 'touch_batch_size')
+    batch_max_time = conf.getfloat(section, 'touch_batch_max_time')
+    batch = []
+    batch_started_at = None
+    batch_received = 0
+    uncommitted = {}  # ring index -> position to commit after the batch is touched
+    replay = None  # spill file being replayed
+    spill_checked_at = 0
+    # On termination by the watchdog (e.g. on reload), touch everything
+    # already received instead of leaving it to the next updater. Exit only
+    # when no keys arrive until stop_at: listeners stopped by the same
+    # signal or by the death of the watchdog may still be flushing buckets.
+    stop_signals = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_signals.append(signum))
+    stop_at = None
+
+    # Rings may already contain keys not processed by the previous updater
+    # (or kept in the journal), so read them without waiting for new writes.
+    updater_wakeup.notify()
+
     while True:
-        if not check_parent_running(log, ppid):
+        profiler.check()
+        if stop_at is None:
+            if stop_signals:
+                stop_at = time.time() + UPDATER_STOP_QUIET_TIME
+            elif not check_parent_running(log, ppid):
+                # Listeners notice the death on their next check only.
+                stop_at = time.time() + 2 * PARENT_CHECK_TIMEOUT
+        stopping = stop_at is not None
+        timeout = PARENT_CHECK_TIMEOUT
+        if stopping:
+            timeout = max(stop_at - time.time(), 0)
+        elif batch:
+            timeout = min(max(batch_started_at + batch_max_time - time.time(), 0), timeout)
+        elif replay is not None:
+            timeout = 0
+        if updater_wakeup.wait(timeout) or stopping:
+            # The wakeup is reset BEFORE reading: a write after this point
+            # notifies it again, so it is never missed.
+            for i, ring in enumerate(updater_rings):
+                keys, pos = ring.read()
+                if not keys:
+                    continue
+                log_section.debug("Received a command to touch %d keys, ring usage: %d%%", len(keys), ring.usage() * 100)
+                log_section.debug("Keys: %s", keys)
+                uncommitted[i] = pos
+                if stopping:
+                    stop_at = max(stop_at, time.time() + UPDATER_STOP_QUIET_TIME)
+                batch_received += len(keys)
+                num_received = len(keys)
+                keys = touch_filter.filter(keys)
+                updater_metrics.inc("cachelrud_updater_keys_received_total", "", num_received)
+                updater_metrics.inc("cachelrud_updater_keys_skipped_total", "", num_received - len(keys))
+                if keys and not batch:
+                    batch_started_at = time.time()
+                batch.extend(keys)
+
+        # Keys spilled while the rings were full are replayed once the
+        # rings are drained, and in the gaps of new keys after that. The
+        # spill is left to the next updater on stop.
+        if not stopping and replay is None and not batch and time.time() >= spill_checked_at + SPILL_CHECK_INTERVAL:
+            spill_checked_at = time.time()
+            for ring in updater_rings:
+                if ring.spill is not None and ring.usage() == 0 and ring.spill.take():
+                    log_section.info("Replaying keys spilled while the ring was full")
+                    replay = ring.spill
+                    break
+        if not stopping and replay is not None and len(batch) < batch_size and all(
+            ring.usage() < SPILL_REPLAY_MAX_USAGE for ring in updater_rings
+        ):
+            keys = replay.read(batch_size - len(batch))
+            if keys:
+                batch_received += len(keys)
+                num_received = len(keys)
+                keys = touch_filter.filter(keys)
+                updater_metrics.inc("cachelrud_updater_keys_replayed_total", "", num_received)
+                updater_metrics.inc("cachelrud_updater_keys_skipped_total", "", num_received - len(keys))
+                if keys and not batch:
+                    batch_started_at = time.time()
+                batch.extend(keys)
+            elif not batch:
+                # Every replayed key is touched or skipped.
+                replay.done()
+                replay = None
+
+        if batch and (stopping or len(batch) >= batch_size or time.time() >= batch_started_at + batch_max_time):
+            if storage is None:
+                storage = get_storage(log_section, dict(conf.items(section)))
+            log_section.debug("Touching %d keys", len(batch))
+            t0 = time.time()
+            storage.touch_keys(batch)
+            dt = time.time() - t0
+            updater_metrics.inc("cachelrud_updater_keys_touched_total", "", len(batch))
+            updater_metrics.observe("cachelrud_updater_touch_duration_seconds", "", dt)
+            updater_metrics.observe("cachelrud_updater_batch_latency_seconds", "", time.time() - batch_started_at)
+            log_section.info(
+                "Touched %d keys (%d skipped as touched recently), took %d ms, %d keys/s, batch latency %d ms",
+                len(batch), batch_received - len(batch), int(dt * 1000),
+                len(batch) / max(dt, 0.001), int((time.time() - batch_started_at) * 1000)
+            )
+            batch = []
+            batch_received = 0
+
+        if not batch and uncommitted:
+            # Everything read so far is either touched or skipped.
+            for i, pos in uncommitted.items():
+                updater_rings[i].commit(pos)
+            uncommitted = {}
+
+        if stopping and not batch and time.time() >= stop_at:
+            log_section.info("All received keys are processed, exiting")
+            profiler.stop()
             return
-        try:
-            section, keys = updater_queue.get(True, PARENT_CHECK_TIMEOUT)
-        except QueueEmpty:
-            continue
-        log_section = log.getChild(section)
-        log_section.debug("Received a command to touch %d keys", len(keys))
-        log_section.debug("Keys: %s", keys)
-        if section not in storages:
-            storages[section] = get_storage(log, dict(conf.items(section)))
-        log_section.debug("Touching %d keys", len(keys))
-        t0 = time.time()
-        storages[section].touch_keys(keys)
-        dt = time.time() - t0
-        log_section.info("Touched %d keys, took %d ms", len(keys), int(dt * 1000))
 
 
-def loop_reaper(log, conf):
+def loop_reaper(log, conf, reaper_groups, reaper_metrics, profiler):
     """
     :type log: logging.Logger
     :type conf: ConfigParser
+    :type reaper_groups: list[(str, list[str])]  budget groups reaped by this process
+    :type reaper_metrics: metrics.SharedMetrics
+    :type profiler: SignalProfiler
     """
     daemon_helper.set_process_name(log.name)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
     ppid = os.getppid()
+    profiler.install(log)
     storages = {}
+    controllers = {}
+    estimators = {}
     next_round_time = {}
+    failures = {}
+    leases = {}
     while True:
+        profiler.check()
         if not check_parent_running(log, ppid):
             return
 
-        for section in conf.sections():
+        # Leases are renewed on their own schedule: rounds of a group may be
+        # much more than reaper_lease_ttl apart. A node which is not
+        # writable lets its lease expire, so others take its partition.
+        for section, lease in leases.items():
             t0 = time.time()
-            if section in next_round_time and t0 < next_round_time[section]:
+            if t0 < lease.next_renewal():
+                continue
+            try:
+                if storages[section].can_write():
+                    lease.renew(log.getChild(section), storages[section], t0)
+            except Exception, e:
+                reaper_metrics.inc("cachelrud_reaper_errors_total", metrics.format_labels([("section", section)]))
+                log.getChild(section).error("Cannot renew the lease: %s: %s", e.__class__.__name__, str(e))
+
+        for group, sections in reaper_groups:
+            t0 = time.time()
+            if group in next_round_time and t0 < next_round_time[group]:
+                continue
+
+            # Collect stats of all sections sharing the same budget.
+            stats = {}
+            oldest = {}
+            fresh_stat = False
+            retry_in = None
+            for section in sections:
+                log_section = log.getChild(section)
+                if section not in estimators:
+                    estimators[section] = StatEstimator(conf.getfloat(section, 'reaper_stat_refresh_interval'))
+                estimator = estimators[section]
+                try:
+                    # A storage is kept on errors: its client is shared by all
+                    # sections with the same DSN and reconnects by itself.
+                    if section not in storages:
+                        storages[section] = get_storage(log_section, dict(conf.items(section)))
+                    storage = storages[section]
+                    if not storage.can_write():
+                        log_section.debug(
+                            "This connection is not writable. Possibly the node is not master, so retry in %d seconds.",
+                            ERROR_RECOVER_RECHECK_DT
+                        )
+                        retry_in = ERROR_RECOVER_RECHECK_DT
+                        break
+                    if conf.getint(section, 'reaper_partitioned'):
+                        if section not in leases:
+                            leases[section] = ReaperLease(
+                                conf.get(section, 'reaper_node_name') or socket.gethostname(),
+                                conf.getfloat(section, 'reaper_lease_ttl')
+                            )
+                        leases[section].renew(log_section, storage, t0)
+                    if estimator.need_refresh(t0):
+                        log_section.debug("Getting stats")
+                        size, count = storage.get_stat()
+                        estimator.refresh(t0, size, count)
+                        labels = metrics.format_labels([("section", section)])
+                        reaper_metrics.set("cachelrud_collection_size_bytes", labels, size)
+                        reaper_metrics.set("cachelrud_collection_keys", labels, count)
+                        fresh_stat = True
+                        log_section.debug("Stats: size=%d, count=%d", size, count)
+                    else:
+                        size, count = estimator.get()
+                        log_section.debug("Estimated stats: size=%d, count=%d", size, count)
+                    if len(sections) > 1 and count > 0:
+                        oldest[section] = storage.get_oldest_timestamp(conf.get(section, 'reaper_mode') == "sampled")
+                except Exception, e:
+                    retry_in = count_reaper_error(log_section, reaper_metrics, failures, group, section, e)
+                    break
+                stats[section] = (size, count)
+            if retry_in is not None:
+                next_round_time[group] = t0 + retry_in
                 continue
+
+            if len(sections) == 1:
+                section = sections[0]
+            else:
+                section = get_coldest_section(log.getChild(group), stats, oldest)
+            maxsize = get_maxsize(conf, section)
             log_section = log.getChild(section)
-            if section not in storages:
-                storages[section] = get_storage(log_section, dict(conf.items(section)))
             storage = storages[section]
-            if not storage.can_write():
-                log_section.debug(
-                    "This connection is not writable. Possibly the node is not master, so retry in %d seconds.",
-                    ERROR_RECOVER_RECHECK_DT
+            size = sum(s for s, c in stats.values())
+            count = max(stats[section][1], 1)  # to avoid division by zero
+            avg_size = max(stats[section][0] * 1.0 / count, 1)  # to avoid division by zero
+            reaper_mode = conf.get(section, 'reaper_mode')
+            round_min = conf.getint(section, 'reaper_one_round_min')
+            round_max = get_reaper_round_max(conf, section, reaper_mode)
+            size_aware = conf.getint(section, 'reaper_size_aware')
+            parts = leases[section].count if section in leases else 1
+
+            if conf.getint(section, 'reaper_adaptive'):
+                if group not in controllers:
+                    controllers[group] = RateController(
+                        maxsize,
+                        conf.getfloat(section, 'reaper_target_ratio'),
+                        conf.getfloat(section, 'reaper_small_sleep_between_rounds'),
+                        conf.getfloat(section, 'reaper_recheck_sleep'),
+                        conf.getfloat(section, 'reaper_max_delete_rate'),
+                        round_min, round_max
+                    )
+                controller = controllers[group]
+                if fresh_stat:
+                    controller.observe(t0, size)
+                num_del, sleep = controller.plan(size, avg_size)
+                log_section.debug("Growth rate: %s bytes/s", controller.growth())
+            else:
+                controller = None
+                # Round limits are per reaper: plan for all of them.
+                num_del, sleep = plan_round(
+                    size, maxsize, avg_size, round_min * parts, round_max * parts,
+                    conf.getfloat(section, 'reaper_small_sleep_between_rounds'),
+                    conf.getfloat(section, 'reaper_recheck_sleep'),
+                    conf.getfloat(section, 'reaper_stat_refresh_interval') > 0
                 )
-                del storages[section]
-                next_round_time[section] = t0 + ERROR_RECOVER_RECHECK_DT
+
+            if num_del > 0 and parts > 1:
+                # The other reapers remove their shares at the same time.
+                num_del = (num_del + parts - 1) // parts
+
+            if num_del <= 0 and not fresh_stat:
+                # The estimate does not know about inserts: confirm by real stats.
+                for s in sections:
+                    estimators[s].invalidate()
+                next_round_time[group] = t0
+                continue
+            if num_del <= 0:
+                failures.pop(group, None)
+                log_section.debug("No need to reap anything, will recheck in %d seconds", sleep)
+                next_round_time[group] = t0 + sleep
                 continue
-            log_section.debug("Getting stats")
+            t1 = time.time()
             try:
-                size, count = storage.get_stat()
+                if size_aware:
+                    # The planned count is only an estimate based on the average
+                    # document size: remove this reaper's share of the real
+                    # overage by real sizes, round_max only caps the keys.
+                    overage = controller.overage(size) if controller is not None else size - maxsize
+                    num_bytes = max(overage, avg_size) / parts
+                    log_section.debug("Performing one round of size-aware LRU removal for %d bytes", num_bytes)
+                    num_real_del, num_real_bytes = storage.clean_oldest_bytes(int(num_bytes), round_max)
+                else:
+                    num_real_del = reap_round(log_section, storage, reaper_mode, num_del)
+                    num_real_bytes = num_real_del * avg_size
             except Exception, e:
-                log_section.error("%s: %s", e.__class__.__name__, str(e))
-                del storages[section]
-                next_round_time[section] = t0 + ERROR_RECOVER_RECHECK_DT
+                next_round_time[group] = t0 + count_reaper_error(log_section, reaper_metrics, failures, group, section, e)
                 continue
-            log_section.debug("Stats: size=%d, count=%d", size, count)
-            count = max(count, 1)  # to avoid division by zero
-            avg_size = max(size * 1.0 / count, 1)  # to avoid division by zero
-            maxsize = human_bytes.human2bytes(conf.get(section, 'maxsize'))
-            num_del = int((size - maxsize) / avg_size)
-            if num_del <= 0:
-                dt = conf.getfloat(section, 'reaper_recheck_sleep')
-                log_section.debug("No need to reap anything, will recheck in %d seconds", dt)
-                next_round_time[section] = t0 + dt
-                continue
-            num_del = max(num_del, conf.getint(section, 'reaper_one_round_min'))
-            num_del = min(num_del, conf.getint(section, 'reaper_one_round_max'))
-            log_section.debug("Performing one round of LRU removal for %d keys", num_del)
-            num_real_del = storage.clean_oldest(num_del)
+            failures.pop(group, None)
+            delete_dt = time.time() - t1
+            # Assume the other reapers have removed as much from their partitions.
+            estimators[section].deleted(num_real_del * parts, num_real_bytes * parts)
+            if controller is not None:
+                controller.deleted(num_real_bytes * parts)
             dt = time.time() - t0
-            log_section.info("Removed %d keys, took %d ms", num_real_del, int(dt * 1000))
-            next_round_time[section] = t0 + conf.getfloat(section, 'reaper_small_sleep_between_rounds')
+            labels = metrics.format_labels([("section", section)])
+            reaper_metrics.inc("cachelrud_reaper_rounds_total", labels)
+            reaper_metrics.inc("cachelrud_reaper_keys_removed_total", labels, num_real_del)
+            reaper_metrics.inc("cachelrud_reaper_bytes_removed_total", labels, num_real_bytes)
+            reaper_metrics.observe("cachelrud_reaper_round_keys", labels, num_real_del)
+            reaper_metrics.observe("cachelrud_reaper_delete_duration_seconds", labels, delete_dt)
+            log_section.info(
+                "Removed %d keys (%s), took %d ms",
+                num_real_del, human_bytes.bytes2human(num_real_bytes), int(dt * 1000)
+            )
+            next_round_time[group] = t0 + sleep
 
         if len(next_round_time) > 0:
-            closest_time = min(next_round_time.values())
+            # A renewal still due has failed: it is retried on the next wakeup.
+            now = time.time()
+            renewals = [lease.next_renewal() for lease in leases.values()]
+            closest_time = min(next_round_time.values() + [t for t in renewals if t is not None and t > now])
             dt = closest_time - time.time()
             if dt > 0.01:
                 time.sleep(min(dt, PARENT_CHECK_TIMEOUT))
@@ -380,6 +1276,121 @@ def loop_reaper(log, conf):
             time.sleep(PARENT_CHECK_TIMEOUT)
 
 
+def get_reaper_groups(conf):
+    """
+    Returns sections grouped by budget_group. A section without a budget
+    group is reaped alone (the group name is the section name then).
+
+    :type conf: ConfigParser
+    :rtype: list[(str, list[str])]
+    """
+    groups = []
+    by_name = {}
+    for section in conf.sections():
+        name = conf.get(section, 'budget_group')
+        if not name:
+            groups.append((section, [section]))
+            continue
+        name = "@" + name
+        if name not in by_name:
+            by_name[name] = []
+            groups.append((name, by_name[name]))
+        by_name[name].append(section)
+    return groups
+
+
+def get_maxsize(conf, section):
+    """
+    Returns the size limit of the section: budget_group_maxsize if it is in
+    a budget group (even if it is the only member), otherwise its maxsize.
+
+    :type conf: ConfigParser
+    :type section: str
+    :rtype: int
+    """
+    if conf.get(section, 'budget_group'):
+        return human_bytes.human2bytes(conf.get(section, 'budget_group_maxsize'))
+    return human_bytes.human2bytes(conf.get(section, 'maxsize'))
+
+
+def get_coldest_section(log, stats, oldest):
+    """
+    Returns the non-empty section whose least recently used key is the
+    oldest one: it is the first to be reaped when the group is over budget.
+
+    :type log: logging.Logger
+    :type stats: dict[str, (int, int)]
+    :type oldest: dict[str, datetime.datetime|None]  timestamps of non-empty sections' oldest keys
+    :rtype: str
+    """
+    coldest = None
+    coldest_key = None
+    for section, (size, count) in sorted(stats.items()):
+        if count <= 0:
+            continue
+        ts = oldest[section]
+        # Never touched keys (no timestamp) are the coldest ones.
+        key = (1, ts) if ts is not None else (0,)
+        if coldest is None or key < coldest_key:
+            coldest, coldest_key = section, key
+    log.debug("Coldest section: %s", coldest)
+    return coldest if coldest is not None else sorted(stats.keys())[0]
+
+
+def get_reaper_round_max(conf, section, reaper_mode):
+    """
+    :type conf: ConfigParser
+    :type section: str
+    :type reaper_mode: str
+    :rtype: int
+    """
+    if reaper_mode == "range":
+        return conf.getint(section, 'reaper_range_one_round_max')
+    return conf.getint(section, 'reaper_one_round_max')
+
+
+def count_reaper_error(log, reaper_metrics, failures, group, section, e):
+    """
+    Logs a failed storage call of a reaper and returns the number of
+    seconds to retry in: each consecutive failure of a budget group doubles
+    it. The storage is kept, its client reconnects by itself.
+
+    :type log: logging.Logger
+    :type reaper_metrics: metrics.SharedMetrics
+    :type failures: dict[str, int]
+    :type group: str
+    :type section: str
+    :type e: Exception
+    :rtype: float
+    """
+    reaper_metrics.inc("cachelrud_reaper_errors_total", metrics.format_labels([("section", section)]))
+    failures[group] = failures.get(group, 0) + 1
+    retry_in = min(RECONNECT_BACKOFF_MIN * 2 ** (failures[group] - 1), RECONNECT_BACKOFF_MAX)
+    log.error("%s: %s, retry in %d seconds", e.__class__.__name__, str(e), retry_in)
+    return retry_in
+
+
+def reap_round(log, storage, reaper_mode, num_del):
+    """
+    Performs one round of LRU removal and returns the number of keys removed.
+
+    :type log: logging.Logger
+    :type storage: cachelrud.storage.Base
+    :type reaper_mode: str
+    :type num_del: int
+    :rtype: int
+    """
+    if reaper_mode == "range":
+        log.debug("Performing one round of LRU range removal for %d keys", num_del)
+        return storage.clean_oldest_range(num_del)
+    elif reaper_mode == "sampled":
+        log.debug("Performing one round of sampled LRU removal for %d keys", num_del)
+        return storage.clean_sampled(num_del)
+    else:
+        log.debug("Performing one round of LRU removal for %d keys", num_del)
+        return storage.clean_oldest(num_del)
+
+
 def get_storage(log, params):
     """
     :type log: logging.Logger
@@ -392,7 +1403,11 @@ def get_storage(log, params):
         raise Exception("DSN must have a protocol specified, but '%s' given" % dsn)
     storage_name = m.group(1)
     pkg = getattr(__import__(__package__ + ".storage." + storage_name).storage, storage_name)
-    return pkg.Storage.get_instance(log, params)
+    storage = pkg.Storage.get_instance(log, params)
+    threshold = float(params.get('slow_operation_threshold_ms', 0)) / 1000
+    if threshold > 0:
+        storage = SlowOperationLog(storage, log, threshold, params)
+    return storage
 
 
 def check_parent_running(log, ppid):
@@ -0,0 +1,205 @@
+import mmap
+import errno
+import bisect
+import socket
+import struct
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+VALUE = struct.Struct("d")
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROUND_SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+HTTP_TIMEOUT = 1
+
+
+class SharedMetrics(object):
+    """
+    Metrics of one child process in a shared mmap. The watchdog creates it
+    before fork() with all metrics declared, so their places in memory are
+    known to both sides; the child is the only writer, and the watchdog
+    reads it to answer metrics requests. Values are 8-byte aligned doubles,
+    so a reader never sees a half-written one, and no locks are needed.
+
+    A histogram takes len(buckets) + 1 values (the last bucket is +Inf),
+    then its sum and its count. Labels common to all metrics of the process
+    (e.g. its worker number) are given once, other ones in each call.
+    """
+
+    def __init__(self, const_labels, specs):
+        """
+        :type const_labels: str
+        :type specs: list[(str, str, str, tuple)]  kind, name, labels, histogram buckets
+        """
+        self._const_labels = const_labels
+        self._specs = specs
+        self._offsets = {}
+        self._buckets = {}
+        num_values = 0
+        for kind, name, labels, buckets in specs:
+            self._offsets[(name, labels)] = num_values * VALUE.size
+            self._buckets[(name, labels)] = buckets
+            num_values += len(buckets) + 3 if kind == HISTOGRAM else 1
+        self._mem = mmap.mmap(-1, max(num_values, 1) * VALUE.size)
+
+    def _add(self, offset, value):
+        VALUE.pack_into(self._mem, offset, VALUE.unpack_from(self._mem, offset)[0] + value)
+
+    def inc(self, name, labels, value=1):
+        """
+        :type name: str
+        :type labels: str
+        :type value: float
+        :rtype: None
+        """
+        self._add(self._offsets[(name, labels)], value)
+
+    def set(self, name, labels, value):
+        """
+        :type name: str
+        :type labels: str
+        :type value: float
+        :rtype: None
+        """
+        VALUE.pack_into(self._mem, self._offsets[(name, labels)], value)
+
+    def observe(self, name, labels, value):
+        """
+        :type name: str
+        :type labels: str
+        :type value: float
+        :rtype: None
+        """
+        offset = self._offsets[(name, labels)]
+        buckets = self._buckets[(name, labels)]
+        self._add(offset + bisect.bisect_left(buckets, value) * VALUE.size, 1)
+        self._add(offset + (len(buckets) + 1) * VALUE.size, value)
+        self._add(offset + (len(buckets) + 2) * VALUE.size, 1)
+
+    def samples(self):
+        """
+        Returns current values as (kind, name, list of sample lines).
+
+        :rtype: list[(str, str, list[str])]
+        """
+        result = []
+        for kind, name, labels, buckets in self._specs:
+            offset = self._offsets[(name, labels)]
+            labels = join_labels(self._const_labels, labels)
+            if kind != HISTOGRAM:
+                value = VALUE.unpack_from(self._mem, offset)[0]
+                result.append((kind, name, [format_sample(name, labels, value)]))
+                continue
+            values = [
+                VALUE.unpack_from(self._mem, offset + i * VALUE.size)[0]
+                for i in range(len(buckets) + 3)
+            ]
+            lines = []
+            total = 0
+            for i, le in enumerate(list(buckets) + ["+Inf"]):
+                total += values[i]
+                le = le if isinstance(le, str) else "%g" % le
+                lines.append(format_sample(name + "_bucket", join_labels(labels, 'le="%s"' % le), total))
+            lines.append(format_sample(name + "_sum", labels, values[-2]))
+            lines.append(format_sample(name + "_count", labels, values[-1]))
+            result.append((kind, name, lines))
+        return result
+
+
+def format_labels(pairs):
+    """
+    :type pairs: list[(str, str)]
+    :rtype: str
+    """
+    return ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+
+
+def join_labels(*labels):
+    """
+    :rtype: str
+    """
+    return ",".join(l for l in labels if l)
+
+
+def format_sample(name, labels, value):
+    """
+    :type name: str
+    :type labels: str
+    :type value: float
+    :rtype: str
+    """
+    if labels:
+        return "%s{%s} %r" % (name, labels, float(value))
+    return "%s %r" % (name, float(value))
+
+
+def render(samples):
+    """
+    Returns Prometheus text exposition of samples of all processes: lines
+    of the same metric are grouped under one TYPE line.
+
+    :type samples: list[(str, str, list[str])]
+    :rtype: str
+    """
+    kinds = {}
+    lines = {}
+    for kind, name, sample_lines in samples:
+        kinds[name] = kind
+        lines.setdefault(name, []).extend(sample_lines)
+    result = []
+    for name in sorted(lines):
+        result.append("# TYPE %s %s" % (name, kinds[name]))
+        result.extend(lines[name])
+    return "\n".join(result) + "\n"
+
+
+def create_http_socket(address):
+    """
+    Creates a non-blocking listening TCP socket for "host:port" address.
+
+    :type address: str
+    :rtype: socket.socket
+    """
+    host, port = address.rsplit(":", 1)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host if host != "*" else "0.0.0.0", int(port)))
+    sock.listen(16)
+    sock.setblocking(0)
+    return sock
+
+
+def serve_http(sock, get_body):
+    """
+    Answers all pending HTTP requests with the text returned by get_body,
+    whatever is requested. A slow client cannot block the caller for more
+    than HTTP_TIMEOUT seconds.
+
+    :type sock: socket.socket
+    :type get_body: callable
+    :rtype: None
+    """
+    while True:
+        try:
+            conn, addr = sock.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        try:
+            conn.settimeout(HTTP_TIMEOUT)
+            conn.recv(4096)
+            body = get_body()
+            conn.sendall(
+                "HTTP/1.0 200 OK\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                "Content-Length: %d\r\n"
+                "\r\n%s" % (len(body), body)
+            )
+        except socket.error:
+            pass
+        finally:
+            conn.close()
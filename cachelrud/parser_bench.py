@@ -0,0 +1,145 @@
+import sys
+import time
+import getopt
+import logging
+import protocol
+
+UDP_TEXT_SIZE = 10240
+
+
+def main():
+    """
+    Measures how many keys per second one core parses from datagrams and
+    puts into buckets, for the legacy per-line loop and for the current
+    parsers. No sockets and no updaters are involved.
+
+    :rtype: None
+    """
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "sections=", "key-len=", "seconds="])
+    except getopt.GetoptError as err:
+        print str(err)
+        return usage()
+    num_sections = 1
+    key_len = 24
+    seconds = 2.0
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        elif o == "--sections":
+            num_sections = int(a)
+        elif o == "--key-len":
+            key_len = int(a)
+        elif o == "--seconds":
+            seconds = float(a)
+
+    names = ["section%d" % i for i in range(num_sections)]
+    text, binary, num_keys = make_datagrams(names, key_len)
+    print "%d sections, %d-byte keys, %d keys per datagram" % (num_sections, key_len, num_keys)
+    print "text datagram: %d bytes, binary: %d bytes, binary+zlib: %d bytes" % (len(text), len(binary[0]), len(binary[1]))
+    log = logging.getLogger("bench")
+    log.setLevel(logging.INFO)
+    section_ids = dict(enumerate(names))
+    for title, func, data in (
+        ("legacy text loop", lambda d, b: parse_legacy(log, d, names, b), text),
+        ("text fast path", lambda d, b: parse_fast(d, frozenset(names), b), text),
+        ("binary", lambda d, b: parse_binary(d, section_ids, b), binary[0]),
+        ("binary+zlib", lambda d, b: parse_binary(d, section_ids, b), binary[1]),
+    ):
+        rate = measure(func, data, names, num_keys, seconds)
+        print "%-20s %10d keys/s" % (title, rate)
+
+
+def usage():
+    """
+    :rtype: None
+    """
+    print "\n".join((
+        "Usage: " + sys.argv[0] + " [OPTION]...",
+        "    --sections=N          keys in a datagram belong to N sections (default 1)",
+        "    --key-len=N           length of each key (default 24)",
+        "    --seconds=N           duration of each measurement (default 2)",
+    ))
+    sys.exit(1)
+
+
+def make_datagrams(names, key_len):
+    """
+    Returns a text datagram of the typical client size and binary datagrams
+    (raw and zlib-compressed) with the same keys.
+
+    :type names: list[str]
+    :type key_len: int
+    :rtype: (str, (str, str), int)
+    """
+    lines = []
+    batches = {}
+    size = 0
+    i = 0
+    while True:
+        name = names[i % len(names)]
+        key = ("key:%d:" % (i * 7919)).ljust(key_len, "x")
+        line = name + ":" + key + "\n"
+        if size + len(line) > UDP_TEXT_SIZE:
+            break
+        lines.append(line)
+        batches.setdefault(names.index(name), []).append(key)
+        size += len(line)
+        i += 1
+    return "".join(lines), (protocol.encode(batches.items()), protocol.encode(batches.items(), "zlib")), i
+
+
+def measure(func, data, names, num_keys, seconds):
+    """
+    :type func: callable
+    :type data: str
+    :type names: list[str]
+    :type num_keys: int
+    :type seconds: float
+    :rtype: float
+    """
+    buckets = {name: {} for name in names}
+    n = 0
+    t0 = time.time()
+    while True:
+        for _ in xrange(100):
+            func(data, buckets)
+            for name in names:
+                buckets[name] = {}
+        n += 100
+        dt = time.time() - t0
+        if dt >= seconds:
+            return n * num_keys / dt
+
+
+def parse_legacy(log, data, allowed_sections, buckets):
+    """
+    The per-line loop the listener used before protocol.parse_text().
+    """
+    lines = data.split("\n")
+    log.debug("Received a datagram with %d bytes, %d key(s)", len(data), len(lines))
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            section, key = line.split(":", 1)
+            if section not in allowed_sections:
+                log.warning("Unknown section name: '%s'", section)
+                continue
+            buckets[section][key] = 1
+            if len(buckets[section]) >= 1000000:
+                pass
+        except ValueError:
+            log.info("Message should have format 'section_name:id', but '%s' received", line)
+
+
+def parse_fast(data, sections, buckets):
+    batches, unknown, malformed = protocol.parse_text(data, sections)
+    for section, keys in batches.iteritems():
+        buckets[section].update(dict.fromkeys(keys, 1))
+
+
+def parse_binary(data, section_ids, buckets):
+    for section_id, keys in protocol.decode(data):
+        buckets[section_ids[section_id]].update(dict.fromkeys(keys, 1))
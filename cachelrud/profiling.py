@@ -0,0 +1,130 @@
+import os
+import re
+import time
+import signal
+import cProfile
+
+SLOW_OPERATIONS = (
+    "touch_keys", "get_stat", "clean_oldest", "clean_oldest_range", "clean_sampled",
+    "clean_oldest_bytes", "get_oldest_timestamp", "heartbeat",
+)
+SLOW_CONTEXT_OPTIONS = ("dbname", "collection", "reaper_mode", "eviction_policy", "timestampfield")
+SLOW_KEYS_SAMPLE = 5
+
+
+class SignalProfiler(object):
+    """
+    Profiles a child process on demand: SIGUSR1 starts cProfile, the next
+    SIGUSR1 (or max_time seconds) stops it and writes the stats to
+    <profile_dir>/<process name>.<pid>.<time>.prof (see "python -m pstats").
+    Sending the signal to the whole process group profiles all processes at
+    once. The handler only sets a flag, the process loop calls check() on
+    each iteration, so nothing but this check is done while not profiling.
+    """
+
+    def __init__(self, profile_dir, max_time):
+        """
+        :type profile_dir: str
+        :type max_time: float
+        """
+        self._profile_dir = profile_dir
+        self._max_time = max_time
+        self._log = None
+        self._signals = []
+        self._profile = None
+        self._started_at = None
+
+    def install(self, log):
+        """
+        Must be called in the profiled process.
+
+        :type log: logging.Logger
+        :rtype: None
+        """
+        self._log = log
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self._signals.append(signum))
+
+    def check(self):
+        """
+        :rtype: None
+        """
+        if not self._signals and self._profile is None:
+            return
+        toggled = bool(self._signals)
+        del self._signals[:]
+        if self._profile is None:
+            self._log.info("Profiling for at most %d seconds", self._max_time)
+            self._started_at = time.time()
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif toggled or time.time() >= self._started_at + self._max_time:
+            self.stop()
+
+    def stop(self):
+        """
+        Writes the collected profile, if profiling.
+
+        :rtype: None
+        """
+        if self._profile is None:
+            return
+        self._profile.disable()
+        name = "%s.%d.%s.prof" % (self._log.name, os.getpid(), time.strftime("%Y%m%d-%H%M%S"))
+        path = os.path.join(self._profile_dir, re.sub(r'[^\w.#-]', '_', name))
+        try:
+            self._profile.dump_stats(path)
+            self._log.info("Profile of %d seconds is written to %s", time.time() - self._started_at, path)
+        except IOError, e:
+            self._log.error("Cannot write profile to %s: %s", path, str(e))
+        self._profile = None
+
+
+class SlowOperationLog(object):
+    """
+    Wraps a storage to log calls of its database operations which take
+    longer than threshold seconds, with their arguments, results and the
+    section's settings. Other attributes are passed through as is.
+    """
+
+    def __init__(self, storage, log, threshold, params):
+        """
+        :type storage: cachelrud.storage.Base
+        :type log: logging.Logger
+        :type threshold: float
+        :type params: dict
+        """
+        self._storage = storage
+        self._log = log
+        self._threshold = threshold
+        self._context = ", ".join(
+            "%s=%s" % (k, params[k]) for k in SLOW_CONTEXT_OPTIONS if k in params
+        )
+
+    def __getattr__(self, name):
+        attr = getattr(self._storage, name)
+        if name not in SLOW_OPERATIONS:
+            return attr
+
+        def traced(*args):
+            t0 = time.time()
+            result = attr(*args)
+            dt = time.time() - t0
+            if dt >= self._threshold:
+                self._log.warning(
+                    "Slow %s(%s) took %d ms and returned %r (pid=%d, %s)",
+                    name, ", ".join(describe_arg(arg) for arg in args), int(dt * 1000), result,
+                    os.getpid(), self._context
+                )
+            return result
+        return traced
+
+
+def describe_arg(arg):
+    """
+    :type arg: object
+    :rtype: str
+    """
+    if isinstance(arg, list):
+        sample = ", ".join(repr(v) for v in arg[:SLOW_KEYS_SAMPLE])
+        return "[%d keys: %s%s]" % (len(arg), sample, ", ..." if len(arg) > SLOW_KEYS_SAMPLE else "")
+    return repr(arg)
@@ -0,0 +1,263 @@
+import zlib
+import struct
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+# Binary datagram layout (protocol v2), all varints are unsigned LEB128:
+#
+#   MAGIC, VERSION, flags
+#   payload (compressed as a whole if flags say so):
+#     one or more blocks of:
+#       section_id (1 byte, see section_id config option)
+#       number of keys (varint)
+#       for each key, sorted:
+#         length of the prefix shared with the previous key (varint)
+#         length of the rest (varint)
+#         the rest of the key
+#
+# MAGIC is never the first byte of a legacy text datagram ("section:key"
+# lines), so both formats may be sent to the same port.
+MAGIC = "\xc1"
+VERSION = 2
+HEADER_SIZE = 3
+FLAG_ZLIB = 1
+FLAG_LZ4 = 2
+# Protects listeners from compressed datagrams which expand too much.
+MAX_DECODED_SIZE = 1 << 20
+LZ4_SIZE_FORMAT = "<I"
+# Whitespace around lines of a text datagram is not a part of section
+# names and keys, so datagrams with these are parsed line by line.
+TEXT_SLOW_PATH_MARKERS = (" ", "\t", "\r", "\f", "\v", "\n\n")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def is_binary(data):
+    """
+    Tells a binary datagram from a legacy text one.
+
+    :type data: str
+    :rtype: bool
+    """
+    return data[:1] == MAGIC
+
+
+def parse_text(data, sections):
+    """
+    Parses a text datagram ("section:key" lines) into keys per section.
+    Returns keys of known sections, names of unknown sections and
+    malformed lines (without a colon).
+
+    In the most common case (one section per datagram, no whitespace
+    around lines), keys are cut out by a single str.split() call, so no
+    Python code runs per key at all.
+
+    :type data: str
+    :type sections: frozenset[str]
+    :rtype: (dict[str, list[str]], set[str], list[str])
+    """
+    data = data.strip("\n")
+    # A substring search is much faster than a regex character class scan.
+    clean = not any(marker in data for marker in TEXT_SLOW_PATH_MARKERS)
+    colon = data.find(":")
+    if clean and colon > 0:
+        prefix = "\n" + data[0:colon + 1]
+        keys = ("\n" + data).split(prefix)
+        # Every line starts with the same "section:" iff each of them
+        # produced a separator.
+        if len(keys) == data.count("\n") + 2:
+            del keys[0]
+            section = data[0:colon]
+            if section in sections:
+                return {section: keys}, set(), []
+            return {}, set([section]), []
+    result = {}
+    malformed = []
+    for line in data.split("\n"):
+        if not clean:
+            line = line.strip()
+            if not line:
+                continue
+        section, colon, key = line.partition(":")
+        if not colon:
+            if line:
+                malformed.append(line)
+            continue
+        keys = result.get(section)
+        if keys is None:
+            keys = result[section] = []
+        keys.append(key)
+    unknown = set(result) - sections
+    for section in unknown:
+        del result[section]
+    return result, unknown, malformed
+
+
+def encode(batches, compression=None):
+    """
+    Builds a binary datagram. Keys are sorted to share prefixes. The
+    caller is responsible for the datagram to fit the UDP size limit.
+
+    :type batches: list[(int, list[str])]
+    :type compression: str|None  None, "zlib" or "lz4"
+    :rtype: str
+    """
+    out = []
+    for section_id, keys in batches:
+        out.append(chr(section_id))
+        out.append(_encode_varint(len(keys)))
+        prev = ""
+        for key in sorted(keys):
+            shared = _common_prefix_length(prev, key)
+            out.append(_encode_varint(shared))
+            out.append(_encode_varint(len(key) - shared))
+            out.append(key[shared:])
+            prev = key
+    payload = "".join(out)
+    flags = 0
+    if compression == "zlib":
+        payload = zlib.compress(payload)
+        flags = FLAG_ZLIB
+    elif compression == "lz4":
+        if lz4_block is None:
+            raise ProtocolError("lz4 compression requires lz4 module to be installed")
+        payload = lz4_block.compress(payload)
+        flags = FLAG_LZ4
+    elif compression is not None:
+        raise ProtocolError("Unknown compression '%s'" % compression)
+    return MAGIC + chr(VERSION) + chr(flags) + payload
+
+
+def decode(data):
+    """
+    Parses a binary datagram. Empty keys and keys with newlines (they
+    cannot be passed to updaters) are skipped.
+
+    :type data: str
+    :rtype: list[(int, list[str])]
+    """
+    if len(data) < HEADER_SIZE or data[0] != MAGIC:
+        raise ProtocolError("Not a binary datagram")
+    version = ord(data[1])
+    if version != VERSION:
+        raise ProtocolError("Unsupported protocol version %d" % version)
+    payload = _decompress(data[HEADER_SIZE:], ord(data[2]))
+    end = len(payload)
+    pos = 0
+    result = []
+    try:
+        while pos < end:
+            section_id = ord(payload[pos])
+            count, pos = _decode_varint(payload, pos + 1)
+            keys = []
+            prev = ""
+            for _ in xrange(count):
+                # Varints are inlined for the common single-byte case:
+                # function calls dominate the cost of this loop.
+                shared = ord(payload[pos])
+                if shared < 0x80:
+                    pos += 1
+                else:
+                    shared, pos = _decode_varint(payload, pos)
+                length = ord(payload[pos])
+                if length < 0x80:
+                    pos += 1
+                else:
+                    length, pos = _decode_varint(payload, pos)
+                if shared > len(prev) or pos + length > end:
+                    raise ProtocolError("Malformed key at offset %d" % pos)
+                key = prev[:shared] + payload[pos:pos + length]
+                pos += length
+                prev = key
+                if key and "\n" not in key:
+                    keys.append(key)
+            result.append((section_id, keys))
+    except IndexError:
+        raise ProtocolError("Truncated datagram")
+    return result
+
+
+def _decompress(payload, flags):
+    """
+    :type payload: str
+    :type flags: int
+    :rtype: str
+    """
+    if flags & ~(FLAG_ZLIB | FLAG_LZ4):
+        raise ProtocolError("Unknown flags 0x%02x" % flags)
+    if flags & FLAG_ZLIB:
+        decompressor = zlib.decompressobj()
+        try:
+            payload = decompressor.decompress(payload, MAX_DECODED_SIZE)
+        except zlib.error, e:
+            raise ProtocolError("Cannot decompress zlib payload: %s" % e)
+        if decompressor.unconsumed_tail:
+            raise ProtocolError("Decompressed payload exceeds %d bytes" % MAX_DECODED_SIZE)
+    elif flags & FLAG_LZ4:
+        if lz4_block is None:
+            raise ProtocolError("lz4 compressed datagram received, but lz4 module is not installed")
+        if len(payload) < struct.calcsize(LZ4_SIZE_FORMAT):
+            raise ProtocolError("Truncated lz4 payload")
+        if struct.unpack_from(LZ4_SIZE_FORMAT, payload)[0] > MAX_DECODED_SIZE:
+            raise ProtocolError("Decompressed payload exceeds %d bytes" % MAX_DECODED_SIZE)
+        try:
+            payload = lz4_block.decompress(payload)
+        except Exception, e:
+            raise ProtocolError("Cannot decompress lz4 payload: %s" % e)
+    return payload
+
+
+def _encode_varint(value):
+    """
+    :type value: int
+    :rtype: str
+    """
+    out = []
+    while value >= 0x80:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+    return "".join(out)
+
+
+def _decode_varint(data, pos):
+    """
+    Returns the value and the position after it.
+
+    :type data: str
+    :type pos: int
+    :rtype: (int, int)
+    """
+    byte = ord(data[pos])
+    if byte < 0x80:
+        # The most common case: short keys and small counts.
+        return byte, pos + 1
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+        if shift > 35:
+            raise ProtocolError("Varint is too long at offset %d" % pos)
+
+
+def _common_prefix_length(a, b):
+    """
+    :type a: str
+    :type b: str
+    :rtype: int
+    """
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
@@ -0,0 +1,253 @@
+class RateController(object):
+    """
+    Feedback controller for one section's reaper. It estimates how fast the
+    collection grows (bytes per second, exponentially smoothed) from
+    successive size samples and the amount of bytes the reaper removed in
+    between, and plans each round so the collection size stays within
+    [maxsize * target_ratio, maxsize]:
+
+    - below the band, it sleeps until the size is expected to reach the
+      band at the current growth rate (but not longer than max_sleep);
+    - above the band, it removes the overage plus what is expected to be
+      inserted until the next round; if it does not fit into one round,
+      rounds go back to back, limited by max_delete_rate only.
+    """
+
+    SMOOTHING = 0.3
+
+    def __init__(self, maxsize, target_ratio, min_sleep, max_sleep, max_delete_rate, round_min, round_max):
+        """
+        :type maxsize: int
+        :type target_ratio: float
+        :type min_sleep: float
+        :type max_sleep: float
+        :type max_delete_rate: float
+        :type round_min: int
+        :type round_max: int
+        """
+        self._target = maxsize * target_ratio
+        self._min_sleep = min_sleep
+        self._max_sleep = max_sleep
+        self._max_delete_rate = max_delete_rate
+        self._round_min = round_min
+        self._round_max = round_max
+        self._growth = None
+        self._prev_time = None
+        self._prev_size = None
+        self._deleted_bytes = 0
+
+    def growth(self):
+        """
+        Returns the smoothed growth rate in bytes per second (not counting
+        the removed keys), or None if unknown yet.
+
+        :rtype: float|None
+        """
+        return self._growth
+
+    def observe(self, now, size):
+        """
+        Feeds a new size sample (e.g. from collStats).
+
+        :type now: float
+        :type size: int
+        :rtype: None
+        """
+        if self._prev_time is not None and now > self._prev_time:
+            growth = (size - self._prev_size + self._deleted_bytes) / (now - self._prev_time)
+            if self._growth is None:
+                self._growth = growth
+            else:
+                self._growth += self.SMOOTHING * (growth - self._growth)
+        self._prev_time = now
+        self._prev_size = size
+        self._deleted_bytes = 0
+
+    def deleted(self, num_bytes):
+        """
+        Registers bytes removed by the reaper since the last observe().
+
+        :type num_bytes: float
+        :rtype: None
+        """
+        self._deleted_bytes += num_bytes
+
+    def overage(self, size):
+        """
+        Returns the number of bytes to remove right now: the size over the
+        band plus what is expected to be inserted until the next round.
+
+        :type size: int
+        :rtype: float
+        """
+        return size - self._target + max(self._growth or 0, 0) * self._min_sleep
+
+    def plan(self, size, avg_size):
+        """
+        Returns the number of keys to remove right now and the number of
+        seconds to sleep before the next round.
+
+        :type size: int
+        :type avg_size: float
+        :rtype: (int, float)
+        """
+        growth = max(self._growth or 0, 0)
+        if size <= self._target:
+            if self._growth is None:
+                # Do not wait too long for the second sample to know the growth.
+                sleep = self._max_sleep / 4
+            elif growth > 0:
+                # Recheck at half of the expected time to reach the band.
+                sleep = (self._target - size) / growth / 2
+            else:
+                sleep = self._max_sleep
+            return 0, min(max(sleep, self._min_sleep), self._max_sleep)
+        num_del = int(self.overage(size) / avg_size)
+        sleep = self._min_sleep
+        if num_del >= self._round_max:
+            num_del = self._round_max
+            sleep = 0
+        num_del = max(num_del, self._round_min)
+        if self._max_delete_rate > 0:
+            sleep = max(sleep, num_del * 1.0 / self._max_delete_rate)
+        return num_del, sleep
+
+
+class StatEstimator(object):
+    """
+    Keeps a running estimate of a collection size and count, so the reaper
+    does not need to run an expensive collStats (it fans out to all shards
+    of a sharded collection) before every round. The estimate is corrected
+    by real stats every refresh_interval seconds; in between, the bytes and
+    keys removed by the reaper are subtracted. Inserts are not seen by the
+    estimate, so it is only trusted to say "still over the limit": once it
+    drops under the limit, the caller should invalidate() it.
+    """
+
+    def __init__(self, refresh_interval):
+        """
+        :type refresh_interval: float
+        """
+        self._refresh_interval = refresh_interval
+        self._refreshed_at = None
+        self._size = 0
+        self._count = 0
+
+    def need_refresh(self, now):
+        """
+        :type now: float
+        :rtype: bool
+        """
+        return self._refreshed_at is None or now >= self._refreshed_at + self._refresh_interval
+
+    def refresh(self, now, size, count):
+        """
+        :type now: float
+        :type size: int
+        :type count: int
+        :rtype: None
+        """
+        self._refreshed_at = now
+        self._size = size
+        self._count = count
+
+    def invalidate(self):
+        """
+        :rtype: None
+        """
+        self._refreshed_at = None
+
+    def deleted(self, count, num_bytes):
+        """
+        :type count: int
+        :type num_bytes: float
+        :rtype: None
+        """
+        self._count = max(self._count - count, 0)
+        self._size = max(self._size - num_bytes, 0)
+
+    def get(self):
+        """
+        :rtype: (int, int)
+        """
+        return int(self._size), self._count
+
+
+class ReaperLease(object):
+    """
+    Coordinates reapers of one collection running on several nodes (e.g.
+    on every node of a replica set). Each reaper renews its lease in the
+    storage every ttl / 3 seconds; the nodes with live leases, sorted by
+    name, divide the keys into partitions, and each reaper removes keys of
+    its own partition only. A node which has not renewed its lease for ttl
+    seconds is not counted anymore, so its partition is taken over by the
+    others. While the set of nodes changes, two reapers may briefly share a
+    partition (removing a key twice is harmless) or leave one unreaped.
+    """
+
+    def __init__(self, node, ttl):
+        """
+        :type node: str
+        :type ttl: float
+        """
+        self._node = node
+        self._ttl = ttl
+        self._renew_at = None
+        self.index = 0
+        self.count = 1
+
+    def renew(self, log, storage, now):
+        """
+        Renews the lease if it is time to and applies the current
+        partition to the storage.
+
+        :type log: logging.Logger
+        :type storage: cachelrud.storage.Base
+        :type now: float
+        :rtype: None
+        """
+        if self._renew_at is not None and now < self._renew_at:
+            return
+        nodes = storage.heartbeat(self._node, self._ttl)
+        index = nodes.index(self._node) if self._node in nodes else 0
+        count = max(len(nodes), 1)
+        if self._renew_at is None or (index, count) != (self.index, self.count):
+            log.info("Reaping partition %d of %d, reapers: %s", index + 1, count, ", ".join(nodes))
+            storage.set_partition(index, count)
+        self.index = index
+        self.count = count
+        self._renew_at = now + self._ttl / 3.0
+
+    def next_renewal(self):
+        """
+        Returns the time renew() has to be called at (None before the
+        first call).
+
+        :rtype: float|None
+        """
+        return self._renew_at
+
+
+def plan_round(size, maxsize, avg_size, round_min, round_max, small_sleep, recheck_sleep, cheap_stats):
+    """
+    Plans a round of the non-adaptive reaper: returns the number of keys
+    to remove right now (not positive if the collection is within
+    maxsize) and the number of seconds to sleep before the next round.
+
+    :type size: int
+    :type maxsize: int
+    :type avg_size: float
+    :type round_min: int
+    :type round_max: int
+    :type small_sleep: float
+    :type recheck_sleep: float
+    :type cheap_stats: bool
+    :rtype: (int, float)
+    """
+    num_del = int((size - maxsize) / avg_size)
+    if num_del > 2 * round_max and cheap_stats:
+        # Far over the limit, and rounds are cheap without collStats.
+        return round_max, 0
+    if num_del > 0:
+        return min(max(num_del, round_min), round_max), small_sleep
+    return num_del, recheck_sleep
@@ -0,0 +1,329 @@
+import os
+import mmap
+import fcntl
+import errno
+import select
+import struct
+
+HEADER_SIZE = 64
+HEAD_OFFSET = 0
+TAIL_OFFSET = 8
+POS_FORMAT = "<Q"
+LEN_FORMAT = "<I"
+LEN_SIZE = struct.calcsize(LEN_FORMAT)
+WRAP_MARKER = 0xffffffff
+
+
+class Wakeup(object):
+    """
+    Lets producers wake up a consumer sleeping in another process. Based on
+    a non-blocking pipe: unlike multiprocessing.Event, it never deadlocks
+    when a process is killed in the middle of set() or wait().
+    """
+
+    def __init__(self):
+        self._rfd, self._wfd = os.pipe()
+        for fd in (self._rfd, self._wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def notify(self):
+        """
+        :rtype: None
+        """
+        try:
+            os.write(self._wfd, "\0")
+        except OSError, e:
+            # The pipe is full: the consumer will wake up anyway.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout):
+        """
+        Returns True if notify() was called since the previous wait().
+
+        :type timeout: float
+        :rtype: bool
+        """
+        try:
+            if not select.select([self._rfd], [], [], timeout)[0]:
+                return False
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return True
+
+
+class SpillFile(object):
+    """
+    Overflow of a file-backed ring: keys which do not fit into the ring are
+    appended to this file by the producer (as newline-separated lines) and
+    replayed by the consumer once it has caught up, so an overloaded
+    updater delays touches instead of losing them.
+
+    The consumer takes the whole file at once by renaming it to
+    "<path>.replay" under an exclusive lock, and the producer checks under
+    the same lock that the file it appends to is still the current one,
+    so no key is ever written into a file being replayed. The replay file
+    is removed only after all its keys are processed: a consumer killed in
+    the middle of it replays it again from the beginning.
+    """
+
+    def __init__(self, path, max_size):
+        """
+        :type path: str
+        :type max_size: int
+        """
+        self._path = path
+        self._replay_path = path + ".replay"
+        self._max_size = max_size
+        self._replay = None
+
+    def append(self, keys):
+        """
+        Appends keys to the file. Returns the number of keys which did not
+        fit (the file would grow larger than max_size, they are discarded).
+
+        :type keys: list[str]
+        :rtype: int
+        """
+        data = "".join(key + "\n" for key in keys)
+        while True:
+            fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino == os.stat(self._path).st_ino:
+                    break
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    os.close(fd)
+                    raise
+            # Taken by the consumer while this process was waiting for the lock.
+            os.close(fd)
+        try:
+            if os.fstat(fd).st_size + len(data) > self._max_size:
+                return len(keys)
+            while data:
+                data = data[os.write(fd, data):]
+            return 0
+        finally:
+            os.close(fd)
+
+    def take(self):
+        """
+        Starts replaying spilled keys (or continues replaying the ones left
+        by the previous consumer). Returns False if there is nothing to
+        replay.
+
+        :rtype: bool
+        """
+        if self._replay is not None or os.path.exists(self._replay_path):
+            return True
+        try:
+            fd = os.open(self._path, os.O_RDONLY)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        try:
+            # Waits for a producer in the middle of append().
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.rename(self._path, self._replay_path)
+        finally:
+            os.close(fd)
+        return True
+
+    def read(self, max_keys):
+        """
+        Returns up to max_keys replayed keys following the ones returned
+        before, or an empty list at the end of the replay file.
+
+        :type max_keys: int
+        :rtype: list[str]
+        """
+        if self._replay is None:
+            self._replay = open(self._replay_path)
+        keys = []
+        while len(keys) < max_keys:
+            line = self._replay.readline()
+            if not line:
+                break
+            keys.append(line.rstrip("\n"))
+        return keys
+
+    def done(self):
+        """
+        Removes the replay file after all its keys are processed.
+
+        :rtype: None
+        """
+        self._replay.close()
+        self._replay = None
+        os.unlink(self._replay_path)
+
+
+class ShmRing(object):
+    """
+    Single-producer single-consumer ring buffer in a shared mmap.
+
+    It must be created before fork(): the producer and the consumer are
+    child processes which inherit the same memory pages. If path is given,
+    the mmap is backed by that file and survives restarts of the daemon:
+    unread keys are picked up by the next consumer (a journal of hits), and
+    keys which do not fit go to its spill file (see SpillFile) if
+    spill_max_size is given. The ring contains length-prefixed records,
+    each record is a batch of newline-separated keys (keys cannot contain
+    newlines, they are split by newlines while receiving). So writing and reading a batch costs a couple of memory
+    copies and no pickling.
+
+    Header keeps two monotonically increasing positions: head (advanced
+    by the producer after a record is completely written) and tail
+    (advanced by the consumer after the keys are processed). So a process
+    killed at any moment never leaves a half-written record visible, and
+    unprocessed keys stay in the ring for the next consumer.
+    """
+
+    def __init__(self, size, wakeup, path=None, spill_max_size=0):
+        """
+        :type size: int
+        :type wakeup: Wakeup
+        :type path: str|None
+        :type spill_max_size: int
+        """
+        self._capacity = size
+        self._max_record = size // 4
+        self._wakeup = wakeup
+        self._path = path
+        self.spill = None
+        if path is not None and spill_max_size > 0:
+            self.spill = SpillFile(path + ".spill", spill_max_size)
+        if path is None:
+            self._mem = mmap.mmap(-1, HEADER_SIZE + size)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+            try:
+                if os.fstat(fd).st_size != HEADER_SIZE + size:
+                    # Records in a ring of another size cannot be read.
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, HEADER_SIZE + size)
+                self._mem = mmap.mmap(fd, HEADER_SIZE + size)
+            finally:
+                os.close(fd)
+        self._read_pos = 0
+
+    def _get_pos(self, offset):
+        return struct.unpack_from(POS_FORMAT, self._mem, offset)[0]
+
+    def _set_pos(self, offset, pos):
+        struct.pack_into(POS_FORMAT, self._mem, offset, pos)
+
+    def sync(self):
+        """
+        Flushes a file-backed ring to disk (a killed process does not lose
+        anything even without this, but the OS crash does).
+
+        :rtype: None
+        """
+        if self._path is not None:
+            self._mem.flush()
+
+    def usage(self):
+        """
+        Returns the fraction of the ring occupied by unread records.
+
+        :rtype: float
+        """
+        return (self._get_pos(HEAD_OFFSET) - self._get_pos(TAIL_OFFSET)) * 1.0 / self._capacity
+
+    def write(self, keys):
+        """
+        Appends keys to the ring. Returns the number of keys which did
+        not fit: they are the last ones, and it is up to the caller to
+        spill or discard them.
+
+        :type keys: list[str]
+        :rtype: int
+        """
+        mem = self._mem
+        head = self._get_pos(HEAD_OFFSET)
+        tail = self._get_pos(TAIL_OFFSET)
+        written = 0
+        for chunk, data in self._split(keys):
+            need = LEN_SIZE + len(data)
+            offset = head % self._capacity
+            pad = 0
+            if offset + need > self._capacity:
+                # Does not fit before the end of the ring, so wrap around.
+                pad = self._capacity - offset
+            if head + pad + need - tail > self._capacity:
+                break
+            if pad:
+                if pad >= LEN_SIZE:
+                    struct.pack_into(LEN_FORMAT, mem, HEADER_SIZE + offset, WRAP_MARKER)
+                head += pad
+                offset = 0
+            struct.pack_into(LEN_FORMAT, mem, HEADER_SIZE + offset, len(data))
+            mem[HEADER_SIZE + offset + LEN_SIZE:HEADER_SIZE + offset + need] = data
+            head += need
+            written += len(chunk)
+        if written:
+            self._set_pos(HEAD_OFFSET, head)
+            self._wakeup.notify()
+        return len(keys) - written
+
+    def _split(self, keys):
+        """
+        Splits keys into records: a record must not occupy the whole ring.
+
+        :type keys: list[str]
+        :rtype: list[(list[str], str)]
+        """
+        if not keys:
+            return []
+        data = "\n".join(keys)
+        if len(data) <= self._max_record or len(keys) == 1:
+            return [(keys, data)]
+        half = len(keys) // 2
+        return self._split(keys[0:half]) + self._split(keys[half:])
+
+    def read(self):
+        """
+        Returns keys written after the previous read() call (or after the
+        last committed position if this process has not read anything yet)
+        and a position to be passed to commit() after the keys are processed.
+
+        :rtype: (list[str], int)
+        """
+        mem = self._mem
+        head = self._get_pos(HEAD_OFFSET)
+        pos = max(self._get_pos(TAIL_OFFSET), self._read_pos)
+        keys = []
+        while pos < head:
+            offset = pos % self._capacity
+            if offset + LEN_SIZE > self._capacity:
+                pos += self._capacity - offset
+                continue
+            length = struct.unpack_from(LEN_FORMAT, mem, HEADER_SIZE + offset)[0]
+            if length == WRAP_MARKER:
+                pos += self._capacity - offset
+                continue
+            start = HEADER_SIZE + offset + LEN_SIZE
+            keys.extend(mem[start:start + length].split("\n"))
+            pos += LEN_SIZE + length
+        self._read_pos = pos
+        return keys, pos
+
+    def commit(self, pos):
+        """
+        Marks everything before pos (returned by read()) as processed.
+
+        :type pos: int
+        :rtype: None
+        """
+        self._set_pos(TAIL_OFFSET, pos)
@@ -0,0 +1,385 @@
+import os
+import sys
+import time
+import getopt
+import heapq
+import itertools
+import human_bytes
+from main import parse_config, get_reaper_round_max
+from touch_filter import TouchFilter
+from reaper_controller import RateController, StatEstimator, plan_round
+
+SIM_SECTION = "simulated"
+# Keys which are inserted but never touched have no timestamp: they go
+# before all touched ones in the timestamp index.
+UNTOUCHED_RANK = -(1 << 62)
+HEAP_COMPACT_MIN = 100000
+BAR_WIDTH = 40
+
+
+def main():
+    """
+    Replays hits captured by listeners (see capture_dir option) through the
+    same bucketing, touch filtering and reaping logic the daemon uses, in
+    simulated time, and prints the hit ratio for each cache size and set of
+    settings given.
+
+    :rtype: None
+    """
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", [
+            "help", "config=", "section=", "sizes=", "default-size=", "maxsize=", "set=", "warmup=", "round-time=",
+        ])
+    except getopt.GetoptError as err:
+        print str(err)
+        return usage()
+    if not args:
+        return usage()
+    configs = [os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + "/..") + "/cachelrud.conf"]
+    section = None
+    sizes_path = None
+    default_size = 1024
+    maxsizes = None
+    variations = []
+    warmup = 0.1
+    round_time = 0.01
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        elif o == "--config":
+            configs.append(a)
+        elif o == "--section":
+            section = a
+        elif o == "--sizes":
+            sizes_path = a
+        elif o == "--default-size":
+            default_size = human_bytes.human2bytes(a)
+        elif o == "--maxsize":
+            maxsizes = [v.strip() for v in a.split(",")]
+        elif o == "--set":
+            name, values = a.split("=", 1)
+            variations.append((name.strip(), [v.strip() for v in values.split(",")]))
+        elif o == "--warmup":
+            warmup = float(a)
+        elif o == "--round-time":
+            round_time = max(float(a), 0.001)
+
+    conf = parse_config(configs)
+    if section is None:
+        if len(conf.sections()) > 1:
+            return usage("Config has several sections, choose one with --section.")
+        if not conf.sections():
+            conf.add_section(SIM_SECTION)
+        section = conf.sections()[0]
+    if maxsizes is None:
+        maxsizes = [conf.get(section, "maxsize")]
+
+    t0 = time.time()
+    times, keys = load_trace(args)
+    sizes = load_sizes(sizes_path) if sizes_path else {}
+    print "Loaded %d hits in %.1f seconds" % (len(keys), time.time() - t0)
+    if not keys:
+        return
+    print_trace_summary(times, keys, sizes, default_size, warmup)
+
+    print "%10s  %-40s %8s %10s %10s %8s %9s" % (
+        "maxsize", "settings", "hit%", "misses", "evicted", "rounds", "peak/max"
+    )
+    names = [name for name, values in variations]
+    for values in itertools.product(*[values for name, values in variations]):
+        settings = ", ".join("%s=%s" % item for item in zip(names, values))
+        for name, value in zip(names, values):
+            conf.set(section, name, value)
+        for maxsize in maxsizes:
+            conf.set(section, "maxsize", maxsize)
+            t0 = time.time()
+            result = simulate(conf, section, times, keys, sizes, default_size, warmup, round_time)
+            dt = time.time() - t0
+            print "%10s  %-40s %7.2f%% %10d %10d %8d %8.2fx  %s  (%d hits/s)" % (
+                maxsize, settings or "-", result.hit_ratio() * 100, result.misses, result.evicted, result.rounds,
+                result.peak_size * 1.0 / max(human_bytes.human2bytes(maxsize), 1),
+                "#" * int(result.hit_ratio() * BAR_WIDTH), len(keys) / max(dt, 0.001)
+            )
+
+
+def usage(msg=None):
+    """
+    :type msg: str|None
+    :rtype: None
+    """
+    if msg:
+        print msg
+    print "\n".join((
+        "Usage: " + sys.argv[0] + " [OPTION]... TRACE_FILE...",
+        "Replays captured hits (see capture_dir option) and prints the hit ratio.",
+        "    --config=FILE         take settings from this config (default: cachelrud.conf defaults)",
+        "    --section=NAME        section of the config to simulate",
+        "    --sizes=FILE          document sizes, \"<key> <bytes>\" lines",
+        "    --default-size=N      size of documents not listed in --sizes (default 1K)",
+        "    --maxsize=N,N,...     cache sizes to simulate (default: maxsize of the section)",
+        "    --set=option=V,V,...  simulate each of these values of a config option (e.g.",
+        "                          bucket_size, bucket_flush_max_time, touch_min_interval,",
+        "                          reaper_one_round_max, reaper_adaptive), repeatable",
+        "    --warmup=F            share of hits not counted while the cache fills (default 0.1)",
+        "    --round-time=N        simulated duration of one reaper round (default 0.01)",
+    ))
+    sys.exit(1)
+
+
+def load_trace(paths):
+    """
+    Reads capture files (each one is ordered by time) and merges them.
+
+    :type paths: list[str]
+    :rtype: (list[float], list[str])
+    """
+    events = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                t, key = line.rstrip("\n").split("\t", 1)
+                events.append((float(t), key))
+    if len(paths) > 1:
+        # Timsort merges the already sorted runs of each file in linear time.
+        events.sort(key=lambda e: e[0])
+    return [t for t, key in events], [key for t, key in events]
+
+
+def load_sizes(path):
+    """
+    :type path: str
+    :rtype: dict[str, int]
+    """
+    sizes = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.rsplit(None, 1)
+            if len(fields) == 2:
+                sizes[fields[0]] = int(fields[1])
+    return sizes
+
+
+def print_trace_summary(times, keys, sizes, default_size, warmup):
+    """
+    Prints what the best possible cache would achieve: with an unlimited
+    size only the first hit of each key is a miss.
+
+    :type times: list[float]
+    :type keys: list[str]
+    :type sizes: dict[str, int]
+    :type default_size: int
+    :type warmup: float
+    :rtype: None
+    """
+    warm = int(len(keys) * warmup)
+    seen = set(keys[:warm])
+    first_hits = 0
+    for key in itertools.islice(keys, warm, None):
+        if key not in seen:
+            seen.add(key)
+            first_hits += 1
+    total_size = sum(sizes.get(key, default_size) for key in seen)
+    print "Trace: %d seconds, %d distinct keys, %s in total" % (
+        times[-1] - times[0], len(seen), human_bytes.bytes2human(total_size)
+    )
+    print "Unlimited cache hit ratio: %.2f%%" % ((1 - first_hits * 1.0 / max(len(keys) - warm, 1)) * 100)
+    print
+
+
+class SimResult(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.rounds = 0
+        self.peak_size = 0
+
+    def hit_ratio(self):
+        """
+        :rtype: float
+        """
+        return self.hits * 1.0 / max(self.hits + self.misses, 1)
+
+
+class SimCache(object):
+    """
+    A simulated collection: keys ordered by their last touch, like the
+    timestamp index the reaper walks. A heap with lazy deletion keeps the
+    order: a touch pushes a new entry, and entries which are not the last
+    ones of their keys are skipped on eviction.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.sizes = {}
+        self._ranks = {}
+        self._heap = []
+        self._seq = 0
+        self._untouched_seq = UNTOUCHED_RANK
+
+    def insert(self, key, size):
+        """
+        :type key: str
+        :type size: int
+        :rtype: None
+        """
+        self._untouched_seq += 1
+        self._ranks[key] = self._untouched_seq
+        self.sizes[key] = size
+        self.size += size
+        heapq.heappush(self._heap, (self._untouched_seq, key))
+
+    def touch(self, keys):
+        """
+        Keys which are not in the collection (e.g. evicted while waiting
+        in a bucket) are ignored, as database updates ignore them.
+
+        :type keys: list[str]
+        :rtype: None
+        """
+        ranks = self._ranks
+        heap = self._heap
+        seq = self._seq
+        for key in keys:
+            if key in ranks:
+                seq += 1
+                ranks[key] = seq
+                heapq.heappush(heap, (seq, key))
+        self._seq = seq
+        if len(heap) > 2 * len(ranks) + HEAP_COMPACT_MIN:
+            self._heap = [(rank, key) for key, rank in ranks.iteritems()]
+            heapq.heapify(self._heap)
+
+    def evict(self, count):
+        """
+        Removes up to count least recently touched keys and returns the
+        number of removed ones.
+
+        :type count: int
+        :rtype: int
+        """
+        ranks = self._ranks
+        heap = self._heap
+        removed = 0
+        while removed < count and heap:
+            rank, key = heapq.heappop(heap)
+            if ranks.get(key) != rank:
+                continue
+            del ranks[key]
+            self.size -= self.sizes.pop(key)
+            removed += 1
+        return removed
+
+
+def simulate(conf, section, times, keys, sizes, default_size, warmup, round_time):
+    """
+    Listener: keys are collected into a bucket which is flushed when it has
+    bucket_size keys or when a hit comes more than bucket_flush_max_time
+    seconds after the previous flush. Updater: flushed keys pass the touch
+    filter and are touched at once (its own batching delay is much shorter
+    than the bucket one and is ignored). Reaper: rounds are planned exactly
+    as by loop_reaper and remove keys in LRU order, whatever reaper_mode and
+    eviction_policy are. A hit of a key which is not in the cache is a miss
+    after which the application stores the key again.
+
+    :type conf: ConfigParser
+    :type section: str
+    :type times: list[float]
+    :type keys: list[str]
+    :type sizes: dict[str, int]
+    :type default_size: int
+    :type warmup: float
+    :type round_time: float
+    :rtype: SimResult
+    """
+    maxsize = human_bytes.human2bytes(conf.get(section, 'maxsize'))
+    bucket_size = conf.getint(section, 'bucket_size')
+    bucket_flush_max_time = conf.getfloat(section, 'bucket_flush_max_time')
+    round_min = conf.getint(section, 'reaper_one_round_min')
+    round_max = get_reaper_round_max(conf, section, conf.get(section, 'reaper_mode'))
+    small_sleep = conf.getfloat(section, 'reaper_small_sleep_between_rounds')
+    recheck_sleep = conf.getfloat(section, 'reaper_recheck_sleep')
+    stat_refresh_interval = conf.getfloat(section, 'reaper_stat_refresh_interval')
+    touch_filter = TouchFilter(
+        conf.getfloat(section, 'touch_min_interval'),
+        conf.getint(section, 'touch_filter_max_keys'),
+        times[0]
+    )
+    estimator = StatEstimator(stat_refresh_interval)
+    controller = None
+    if conf.getint(section, 'reaper_adaptive'):
+        controller = RateController(
+            maxsize,
+            conf.getfloat(section, 'reaper_target_ratio'),
+            small_sleep,
+            recheck_sleep,
+            conf.getfloat(section, 'reaper_max_delete_rate'),
+            round_min, round_max
+        )
+
+    cache = SimCache()
+    result = SimResult()
+
+    def reap_round(now):
+        # Returns the time of the next round, as loop_reaper plans it.
+        fresh_stat = estimator.need_refresh(now)
+        if fresh_stat:
+            estimator.refresh(now, cache.size, len(cache.sizes))
+        size, count = estimator.get()
+        avg_size = max(size * 1.0 / max(count, 1), 1)
+        if controller is not None:
+            if fresh_stat:
+                controller.observe(now, size)
+            num_del, sleep = controller.plan(size, avg_size)
+        else:
+            num_del, sleep = plan_round(
+                size, maxsize, avg_size, round_min, round_max, small_sleep, recheck_sleep, stat_refresh_interval > 0
+            )
+        if num_del <= 0 and not fresh_stat:
+            estimator.invalidate()
+            return now
+        if num_del <= 0:
+            return now + sleep
+        removed = cache.evict(num_del)
+        estimator.deleted(removed, removed * avg_size)
+        if controller is not None:
+            controller.deleted(removed * avg_size)
+        result.evicted += removed
+        result.rounds += 1
+        return now + max(sleep, round_time)
+
+    warm = int(len(keys) * warmup)
+    bucket = {}
+    flushed_at = times[0]
+    next_round_at = times[0]
+    hits = 0
+    misses = 0
+    peak_size = 0
+    cached = cache.sizes
+    for i in xrange(len(keys)):
+        now = times[i]
+        while next_round_at <= now:
+            next_round_at = reap_round(next_round_at)
+        if now > flushed_at + bucket_flush_max_time:
+            flushed_at = now
+            cache.touch(touch_filter.filter(bucket.keys(), now))
+            bucket = {}
+        key = keys[i]
+        if key in cached:
+            if i >= warm:
+                hits += 1
+        else:
+            if i >= warm:
+                misses += 1
+            cache.insert(key, sizes.get(key, default_size))
+            if cache.size > peak_size:
+                peak_size = cache.size
+        bucket[key] = 1
+        if len(bucket) >= bucket_size:
+            flushed_at = now
+            cache.touch(touch_filter.filter(bucket.keys(), now))
+            bucket = {}
+    result.hits = hits
+    result.misses = misses
+    result.peak_size = peak_size
+    return result
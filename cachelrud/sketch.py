@@ -0,0 +1,224 @@
+import math
+import time
+import heapq
+import collections
+
+HLL_PRECISION = 14  # 16K registers, about 0.8% standard error
+HASH_MASK = (1 << 64) - 1
+HASH_MULTIPLIER = 0xff51afd7ed558ccd
+HISTORY_SIZE = 24
+# Counters kept per reported top item: more counters, smaller errors.
+TOP_CAPACITY_FACTOR = 10
+
+
+class SpaceSaving(object):
+    """
+    Finds the most frequent items of a stream in fixed memory (Space-Saving
+    by Metwally et al., with batched evictions). Up to 2 x capacity counters
+    are kept; when there are more, only capacity largest ones survive, and
+    the largest evicted count becomes the floor: an item which is not
+    counted starts from it, because it might have been counted and evicted
+    before. So each count overestimates the real one by at most its error,
+    and any item more frequent than the floor is surely counted.
+    """
+
+    def __init__(self, capacity):
+        """
+        :type capacity: int
+        """
+        self._capacity = capacity
+        self._counts = {}
+        self._errors = {}
+        self._floor = 0
+
+    def add(self, items):
+        """
+        :type items: list[str]
+        :rtype: None
+        """
+        counts = self._counts
+        floor = self._floor
+        for item in items:
+            count = counts.get(item)
+            if count is None:
+                counts[item] = floor + 1
+                if floor:
+                    self._errors[item] = floor
+            else:
+                counts[item] = count + 1
+        if len(counts) > 2 * self._capacity:
+            self._prune()
+
+    def _prune(self):
+        top = sorted(self._counts.iteritems(), key=lambda item: item[1], reverse=True)
+        self._floor = max(self._floor, top[self._capacity][1])
+        self._counts = dict(top[:self._capacity])
+        self._errors = {item: self._errors[item] for item in self._counts if item in self._errors}
+
+    def top(self, n):
+        """
+        Returns n most frequent items with their counts and errors.
+
+        :type n: int
+        :rtype: list[(str, int, int)]
+        """
+        return [
+            (item, count, self._errors.get(item, 0))
+            for item, count in heapq.nlargest(n, self._counts.iteritems(), key=lambda item: item[1])
+        ]
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct items in fixed memory (one byte per
+    register). Adding an item which has already been added changes
+    nothing, so it may be fed with deduplicated batches.
+    """
+
+    def __init__(self, precision=HLL_PRECISION):
+        """
+        :type precision: int
+        """
+        self._precision = precision
+        self._registers = bytearray(1 << precision)
+
+    def add(self, items):
+        """
+        :type items: list[str]
+        :rtype: None
+        """
+        registers = self._registers
+        precision = self._precision
+        index_mask = len(registers) - 1
+        max_rank = 64 - precision + 1
+        for item in items:
+            # Low bits of str hash are poorly distributed for similar keys:
+            # mix them as MurmurHash3 finalizer does.
+            h = hash(item) & HASH_MASK
+            h = ((h ^ (h >> 33)) * HASH_MULTIPLIER) & HASH_MASK
+            h ^= h >> 33
+            index = h & index_mask
+            w = h >> precision
+            # Position of the lowest set bit: as random as the leading zeros.
+            rank = (w & -w).bit_length() if w else max_rank
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def count(self):
+        """
+        :rtype: int
+        """
+        m = len(self._registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self._registers)
+        zeros = self._registers.count("\0")
+        if estimate <= 2.5 * m and zeros:
+            # Small range correction: linear counting.
+            estimate = m * math.log(m * 1.0 / zeros)
+        return int(estimate)
+
+
+class KeyStats(object):
+    """
+    Key popularity of one section in a listener: top_keys most frequent keys
+    and key prefixes (the first prefix_depth parts separated by
+    prefix_delimiter) and the number of distinct keys, per window of window
+    seconds. Distinct counts of the last HISTORY_SIZE windows are kept: it
+    is the working set the cache should hold to serve them.
+    """
+
+    def __init__(self, top_keys, window, prefix_delimiter, prefix_depth, now=None):
+        """
+        :type top_keys: int
+        :type window: float
+        :type prefix_delimiter: str
+        :type prefix_depth: int
+        :type now: float
+        """
+        self._top_keys = top_keys
+        self._window = window
+        self._prefix_delimiter = prefix_delimiter
+        self._prefix_depth = prefix_depth
+        self._history = collections.deque(maxlen=HISTORY_SIZE)
+        self._previous = None
+        self._start(time.time() if now is None else now)
+
+    def _start(self, now):
+        self._started_at = now
+        self._hits = 0
+        self._keys = SpaceSaving(self._top_keys * TOP_CAPACITY_FACTOR)
+        self._prefixes = SpaceSaving(self._top_keys * TOP_CAPACITY_FACTOR)
+        self._distinct = HyperLogLog()
+
+    def _rotate(self, now):
+        if now < self._started_at + self._window:
+            return
+        self._history.append((self._started_at, self._hits, self._distinct.count()))
+        self._previous = (self._started_at, self._hits, self._keys, self._prefixes)
+        self._start(now)
+
+    def add_hits(self, keys, now):
+        """
+        Counts hits of a datagram.
+
+        :type keys: list[str]
+        :type now: float
+        :rtype: None
+        """
+        self._rotate(now)
+        self._hits += len(keys)
+        self._keys.add(keys)
+        delimiter = self._prefix_delimiter
+        depth = self._prefix_depth
+        self._prefixes.add([delimiter.join(key.split(delimiter, depth)[:depth]) for key in keys])
+
+    def add_distinct(self, keys, now):
+        """
+        Counts distinct keys (e.g. of a flushed bucket).
+
+        :type keys: list[str]
+        :type now: float
+        :rtype: None
+        """
+        self._rotate(now)
+        self._distinct.add(keys)
+
+    def last_distinct(self):
+        """
+        Returns the number of distinct keys in the last complete window.
+
+        :rtype: int
+        """
+        return self._history[-1][2] if self._history else 0
+
+    def report(self, now):
+        """
+        :type now: float
+        :rtype: list[str]
+        """
+        self._rotate(now)
+        lines = ["Distinct keys per %d-second window (oldest first):" % self._window]
+        for started_at, hits, distinct in self._history:
+            lines.append("  %s: %d distinct of %d hits" % (format_time(started_at), distinct, hits))
+        lines.append("  %s (current): %d distinct of %d hits" % (
+            format_time(self._started_at), self._distinct.count(), self._hits
+        ))
+        windows = [("current window", self._started_at, self._hits, self._keys, self._prefixes)]
+        if self._previous is not None:
+            windows.append(("previous window",) + self._previous)
+        for title, started_at, hits, keys, prefixes in windows:
+            for kind, item_name, sketch in (("keys", "key", keys), ("prefixes", "prefix", prefixes)):
+                lines.append("Top %s of the %s since %s, %d hits (hits, max overestimate, %s):" % (
+                    kind, title, format_time(started_at), hits, item_name
+                ))
+                for item, count, error in sketch.top(self._top_keys):
+                    lines.append("  %d %d %s" % (count, error, item))
+        return lines
+
+
+def format_time(t):
+    """
+    :type t: float
+    :rtype: str
+    """
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
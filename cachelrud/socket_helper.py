@@ -0,0 +1,118 @@
+import os
+import stat
+import socket
+import select
+import errno
+
+# Not exported by Python 2 socket module, but supported by Linux >= 3.9.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+PROC_NET_UDP_FILES = ("/proc/net/udp", "/proc/net/udp6")
+
+
+def create_udp_socket(listenhost, listenport, rcvbuf, reuseport):
+    """
+    Creates a non-blocking UDP socket. If reuseport is True, SO_REUSEPORT
+    is set, so multiple processes may bind the same port and the kernel
+    balances datagrams among them.
+
+    :type listenhost: str
+    :type listenport: int
+    :type rcvbuf: int
+    :type reuseport: bool
+    :rtype: socket.socket
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    if rcvbuf > 0:
+        # The kernel silently caps this value by net.core.rmem_max.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind((listenhost if listenhost != "*" else "0.0.0.0", listenport))
+    sock.setblocking(0)
+    return sock
+
+
+def create_unix_socket(path, mode, rcvbuf):
+    """
+    Creates a non-blocking unix domain datagram socket. A stale socket
+    file left by a previous process is removed.
+
+    :type path: str
+    :type mode: int
+    :type rcvbuf: int
+    :rtype: socket.socket
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    if rcvbuf > 0:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind(path)
+    os.chmod(path, mode)
+    sock.setblocking(0)
+    return sock
+
+
+def wait_readable(socks, timeout):
+    """
+    Returns sockets which have pending datagrams, waiting for at most
+    timeout seconds. A signal received while waiting is not an error.
+
+    :type socks: list[socket.socket]
+    :type timeout: float
+    :rtype: list[socket.socket]
+    """
+    try:
+        return select.select(socks, [], [], timeout)[0]
+    except select.error, e:
+        if e.args[0] != errno.EINTR:
+            raise
+        return []
+
+
+def recv_batch(sock, bufsize, max_count):
+    """
+    Drains up to max_count pending datagrams from a non-blocking socket
+    without sleeping.
+
+    :type sock: socket.socket
+    :type bufsize: int
+    :type max_count: int
+    :rtype: list[str]
+    """
+    result = []
+    recv = sock.recv
+    try:
+        while len(result) < max_count:
+            result.append(recv(bufsize))
+    except socket.error, e:
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+    return result
+
+
+def get_udp_drops(sock):
+    """
+    Returns the number of datagrams dropped by the kernel for this socket
+    (e.g. because of receive buffer overflow), or None if unknown.
+
+    :type sock: socket.socket
+    :rtype: int|None
+    """
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for path in PROC_NET_UDP_FILES:
+        try:
+            with open(path) as f:
+                f.readline()  # header
+                for line in f:
+                    fields = line.split()
+                    # sl local rem st tx:rx tr:tm retrnsmt uid timeout inode ref pointer drops
+                    if len(fields) >= 13 and fields[9] == inode:
+                        return int(fields[12])
+        except IOError:
+            pass
+    return None
@@ -1,3 +1,125 @@
+import zlib
+
+POLICIES = ("lru", "lfu", "lru2")
+
+
+def get_policy(params):
+    """
+    :type params: dict
+    :rtype: LruPolicy
+    """
+    name = params['eviction_policy']
+    if name == "lru":
+        return LruPolicy(params['timestampfield'])
+    elif name == "lfu":
+        return LfuPolicy(params['timestampfield'], params['hitsfield'], float(params['lfu_half_life']))
+    elif name == "lru2":
+        return Lru2Policy(params['timestampfield'], params['historyfield'])
+    raise Exception("Unknown eviction_policy '%s', allowed: %s" % (name, ", ".join(POLICIES)))
+
+
+def get_partition(_id, count):
+    """
+    Returns the partition (0..count-1) of a key by crc32 of its _id: it is
+    the same on all nodes, so their reapers remove disjoint sets of keys.
+
+    :type _id: object
+    :type count: int
+    :rtype: int
+    """
+    if isinstance(_id, unicode):
+        _id = _id.encode("utf-8")
+    return (zlib.crc32(str(_id)) & 0xffffffff) % count
+
+
+class LruPolicy(object):
+    """
+    Evicts keys with the oldest last access time first.
+    """
+    name = "lru"
+
+    def __init__(self, timestampfield):
+        """
+        :type timestampfield: str
+        """
+        self.timestampfield = timestampfield
+
+    def fields(self):
+        """
+        Document fields needed to calculate score().
+
+        :rtype: list[str]
+        """
+        return [self.timestampfield]
+
+    def score(self, doc, now):
+        """
+        Keys with lower scores are evicted first. Never touched keys (with
+        no timestamp) go before all others.
+
+        :type doc: dict
+        :type now: datetime.datetime
+        :rtype: tuple
+        """
+        ts = doc.get(self.timestampfield)
+        return (1, ts) if ts is not None else (0,)
+
+
+class LfuPolicy(LruPolicy):
+    """
+    Evicts keys with the lowest hits counter first. The counter decays
+    exponentially with time since the last access (halves each half_life
+    seconds), so keys which were popular long ago are evicted eventually.
+    """
+    name = "lfu"
+
+    def __init__(self, timestampfield, hitsfield, half_life):
+        """
+        :type timestampfield: str
+        :type hitsfield: str
+        :type half_life: float
+        """
+        LruPolicy.__init__(self, timestampfield)
+        self.hitsfield = hitsfield
+        self.half_life = half_life
+
+    def fields(self):
+        return [self.timestampfield, self.hitsfield]
+
+    def score(self, doc, now):
+        ts = doc.get(self.timestampfield)
+        if ts is None:
+            return (0,)
+        age = max((now - ts).total_seconds(), 0)
+        return (1, doc.get(self.hitsfield, 0) * 0.5 ** (age / self.half_life))
+
+
+class Lru2Policy(LruPolicy):
+    """
+    LRU-K with K=2: evicts keys with the oldest second-to-last access time
+    first. Keys accessed only once (e.g. by a cache warmer or a crawler
+    scan) go before any key accessed twice, in LRU order among themselves.
+    """
+    name = "lru2"
+
+    def __init__(self, timestampfield, historyfield):
+        """
+        :type timestampfield: str
+        :type historyfield: str
+        """
+        LruPolicy.__init__(self, timestampfield)
+        self.historyfield = historyfield
+
+    def fields(self):
+        return [self.timestampfield, self.historyfield]
+
+    def score(self, doc, now):
+        history = doc.get(self.historyfield) or []
+        if len(history) >= 2:
+            return (2, history[-2])
+        return LruPolicy.score(self, doc, now)
+
+
 class Base(object):
     @classmethod
     def get_instance(cls, log, params):
@@ -16,6 +138,9 @@ class Base(object):
 
     def touch_keys(self, keys):
         """
+        Marks keys as accessed now (maintaining the fields needed by the
+        section's eviction policy).
+
         :type keys: list[str]
         :rtype: None
         """
@@ -29,7 +154,78 @@ class Base(object):
 
     def clean_oldest(self, count):
         """
+        Removes count keys which are the first to evict according to
+        the section's eviction policy.
+
+        :type count: int
+        :rtype: (int, int)
+        """
+        raise NotImplementedError()
+
+    def clean_oldest_range(self, count):
+        """
+        Same as clean_oldest(), but finds a cutoff timestamp first and then
+        removes everything older than it with a single range predicate.
+        Keys at the cutoff timestamp itself are removed by IDs, only as many
+        of them as needed to remove no more than count keys.
+
+        :type count: int
+        :rtype: int
+        """
+        raise NotImplementedError()
+
+    def clean_sampled(self, count):
+        """
+        Approximate LRU which does not need an index on the timestamp: removes
+        count oldest keys among randomly sampled ones.
+
         :type count: int
+        :rtype: int
+        """
+        raise NotImplementedError()
+
+    def clean_oldest_bytes(self, num_bytes, max_count):
+        """
+        Removes oldest keys until their total real size reaches num_bytes
+        (but no more than max_count keys). Returns the number of removed
+        keys and their total size.
+
+        :type num_bytes: int
+        :type max_count: int
         :rtype: (int, int)
         """
         raise NotImplementedError()
+
+    def heartbeat(self, node, ttl):
+        """
+        Renews the lease of the reaper of node for ttl seconds and returns
+        the sorted names of the nodes whose reapers of this collection hold
+        a live lease.
+
+        :type node: str
+        :type ttl: float
+        :rtype: list[str]
+        """
+        raise NotImplementedError()
+
+    def set_partition(self, index, count):
+        """
+        Makes clean_oldest(), clean_oldest_bytes() and clean_sampled()
+        remove only keys of partition index of count (see get_partition()).
+
+        :type index: int
+        :type count: int
+        :rtype: None
+        """
+        raise NotImplementedError()
+
+    def get_oldest_timestamp(self, approximate):
+        """
+        Returns the last access time of the least recently used key (or
+        None if it has never been touched). If approximate is True, it is
+        the oldest one among randomly sampled keys (no index is needed).
+
+        :type approximate: bool
+        :rtype: datetime.datetime|None
+        """
+        raise NotImplementedError()
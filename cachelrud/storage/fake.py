@@ -0,0 +1,130 @@
+from . import *
+from .. import human_bytes
+import re
+import time
+import socket
+import random
+import datetime
+
+#
+# A storage which keeps nothing: it is used by bin/cachelrud-bench to
+# measure the daemon itself. It simulates a collection which is over its
+# maxsize and keeps growing, sleeps to simulate database latency and
+# reports every call to the benchmark by UDP.
+#
+# Input parameters:
+# - dsn: fake://report_host:report_port/ (reports are not sent if no port)
+# - maxsize
+# - fake_doc_size: size of each simulated document
+# - fake_initial_fill: initial collection size relative to maxsize
+# - fake_insert_rate: documents inserted per second
+# - fake_touch_latency_ms: latency of each touch_keys() call
+# - fake_reap_latency_ms: latency of each clean_*() call
+#
+# Report datagrams are lines of space-separated fields:
+#   touch <time> <duration> <number of keys> <probe keys...>
+#   reap <time> <duration> <number of keys>
+# Probe keys are the ones starting with PROBE_PREFIX: the benchmark sends
+# them to measure the end-to-end latency.
+#
+
+PROBE_PREFIX = "probe:"
+MAX_REPORT_SIZE = 60000
+
+
+class Storage(Base):
+    def __init__(self, log, report_addr, count, doc_size, insert_rate, touch_latency, reap_latency):
+        """
+        :type report_addr: (str, int)|None
+        :type count: int
+        :type doc_size: int
+        :type insert_rate: float
+        :type touch_latency: float
+        :type reap_latency: float
+        """
+        self._log = log
+        self._report_addr = report_addr
+        self._report_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if report_addr else None
+        self._count = count
+        self._doc_size = doc_size
+        self._insert_rate = insert_rate
+        self._touch_latency = touch_latency
+        self._reap_latency = reap_latency
+        self._created_at = time.time()
+        self._removed = 0
+
+    @classmethod
+    def get_instance(cls, log, params):
+        """
+        :type log: logging.Logger
+        :type params: dict
+        :rtype: Storage
+        """
+        m = re.match(r'^fake://([^:/]*)(?::(\d+))?/?', params['dsn'])
+        if m is None:
+            raise Exception("Cannot parse fake DSN '%s'!" % params['dsn'])
+        report_addr = (m.group(1) or "127.0.0.1", int(m.group(2))) if m.group(2) else None
+        doc_size = int(params.get('fake_doc_size', 1024))
+        return Storage(
+            log, report_addr,
+            int(human_bytes.human2bytes(params['maxsize']) * float(params.get('fake_initial_fill', 1.1)) / doc_size),
+            doc_size,
+            float(params.get('fake_insert_rate', 1000)),
+            float(params.get('fake_touch_latency_ms', 1)) / 1000,
+            float(params.get('fake_reap_latency_ms', 5)) / 1000,
+        )
+
+    def _report(self, line):
+        if self._report_sock is not None:
+            self._report_sock.sendto(line, self._report_addr)
+
+    def can_write(self):
+        return True
+
+    def touch_keys(self, keys):
+        t0 = time.time()
+        time.sleep(self._touch_latency)
+        probes = [key for key in keys if key.startswith(PROBE_PREFIX)]
+        line = "touch %.6f %.6f %d" % (time.time(), time.time() - t0, len(keys))
+        for probe in probes:
+            if len(line) + len(probe) + 1 > MAX_REPORT_SIZE:
+                self._report(line)
+                line = "touch %.6f 0 0" % time.time()
+            line += " " + probe
+        self._report(line)
+
+    def get_stat(self):
+        count = max(self._count + int((time.time() - self._created_at) * self._insert_rate) - self._removed, 0)
+        return count * self._doc_size, count
+
+    def _clean(self, count):
+        t0 = time.time()
+        time.sleep(self._reap_latency)
+        count = min(count, self.get_stat()[1])
+        self._removed += count
+        self._report("reap %.6f %.6f %d" % (time.time(), time.time() - t0, count))
+        return count
+
+    def clean_oldest(self, count):
+        return self._clean(count)
+
+    def clean_oldest_range(self, count):
+        return self._clean(count)
+
+    def clean_sampled(self, count):
+        return self._clean(count)
+
+    def clean_oldest_bytes(self, num_bytes, max_count):
+        count = self._clean(min(num_bytes / self._doc_size, max_count))
+        return count, count * self._doc_size
+
+    def heartbeat(self, node, ttl):
+        # The only reaper of the simulated collection.
+        return [node]
+
+    def set_partition(self, index, count):
+        pass
+
+    def get_oldest_timestamp(self, approximate):
+        # Sections compete in budget groups: pick one at random.
+        return datetime.datetime.utcnow() - datetime.timedelta(seconds=random.randint(0, 3600))
@@ -3,7 +3,9 @@ import urlparse
 import urllib
 import pymongo
 import re
+import time
 import datetime
+import threading
 
 #
 # Input parameters:
@@ -12,17 +14,79 @@ import datetime
 # - dbname
 # - collection
 # - timestampfield
+# - touch_chunk_size
+# - touch_w
+# - touch_max_in_flight
+# - reaper_sample_size
+# - reaper_sample_pool_size
+# - reaper_size_weight
+# - eviction_policy
+# - hitsfield
+# - historyfield
+# - lfu_half_life
+# - reaper_candidates_factor
+# - reaper_lease_collection
 #
 
+# The index on timestampfield is almost never dropped: it is checked once
+# per this number of seconds, not on each reaper round.
+INDEX_CHECK_INTERVAL = 3600
+
+# Clients of this process by connection URI: all sections with the same
+# DSN share one client (and its connection pool), whatever their dbname is
+# unless the DSN has credentials, and a client reconnects by itself after
+# a failover, so it is never re-created.
+_clients = {}
+# (connection URI, collection full name, field) -> time of the last check.
+_index_checked_at = {}
+
+
+def get_client(log, mongo_dsn):
+    """
+    :type log: logging.Logger
+    :type mongo_dsn: str
+    :rtype: pymongo.Connection
+    """
+    client = _clients.get(mongo_dsn)
+    if client is None:
+        log.debug("Connecting to %s", mongo_dsn)
+        client = pymongo.Connection(mongo_dsn, read_preference=pymongo.ReadPreference.PRIMARY)
+        _clients[mongo_dsn] = client
+    return client
+
+
 class Storage(Base):
-    def __init__(self, log, collection, timestampfield):
+    def __init__(self, log, client_key, collection, policy, touch_chunk_size, touch_w, touch_max_in_flight,
+                 sample_size, sample_pool_size, size_weight, candidates_factor, lease_collection):
         """
+        :type client_key: str
         :type collection: pymongo.collection.Connection
-        :type timestampfield: str
+        :type policy: LruPolicy
+        :type touch_chunk_size: int
+        :type touch_w: int
+        :type touch_max_in_flight: int
+        :type sample_size: int
+        :type sample_pool_size: int
+        :type size_weight: float
+        :type candidates_factor: int
+        :type lease_collection: str
         """
         self._log = log
+        self._index_key = (client_key, collection.full_name, policy.timestampfield)
         self._collection = collection
-        self._timestampfield = timestampfield
+        self._policy = policy
+        self._timestampfield = policy.timestampfield
+        self._touch_chunk_size = max(touch_chunk_size, 1)
+        self._touch_w = touch_w
+        self._touch_max_in_flight = max(touch_max_in_flight, 1)
+        self._sample_size = sample_size
+        self._sample_pool_size = sample_pool_size
+        self._sample_pool = {}  # _id -> document with fields of the best eviction candidates
+        self._size_weight = size_weight
+        self._candidates_factor = max(candidates_factor, 1)
+        self._leases = collection.database[lease_collection]
+        self._partition = 0
+        self._partitions = 1
 
     @classmethod
     def get_instance(cls, log, params):
@@ -41,12 +105,65 @@ class Storage(Base):
             mongo_qs['replicaSet'] = params['replicaSet']
         if 'dbname' in params:
             mongo_dbname = params['dbname']
-        mongo_dsn = mongo_dsn + "/" + mongo_dbname + "?" + urllib.urlencode(mongo_qs)
-        log.debug("Connecting to %s", mongo_dsn)
-        client = pymongo.Connection(mongo_dsn, read_preference=pymongo.ReadPreference.PRIMARY)
+        mongo_qs = urllib.urlencode(mongo_qs)
+        if "@" in mongo_dsn:
+            # Credentials are checked against the database of the URI.
+            mongo_dsn = mongo_dsn + "/" + mongo_dbname + "?" + mongo_qs
+        else:
+            # The database is chosen below, so other sections of this
+            # process (e.g. of the same budget group) share the client.
+            mongo_dsn = mongo_dsn + "/?" + mongo_qs
+        client = get_client(log, mongo_dsn)
         db = client[mongo_dbname]
         collection = db[params['collection']]
-        return Storage(log, collection, params['timestampfield'])
+        return Storage(
+            log, mongo_dsn, collection, get_policy(params),
+            int(params['touch_chunk_size']), int(params['touch_w']), int(params['touch_max_in_flight']),
+            int(params['reaper_sample_size']), int(params['reaper_sample_pool_size']),
+            float(params['reaper_size_weight']), int(params['reaper_candidates_factor']),
+            params['reaper_lease_collection']
+        )
+
+    def _ensure_index(self):
+        """
+        Creates the index on timestampfield if it has not been checked
+        for INDEX_CHECK_INTERVAL seconds by any section of this process.
+
+        :rtype: None
+        """
+        now = time.time()
+        if now < _index_checked_at.get(self._index_key, 0) + INDEX_CHECK_INTERVAL:
+            return
+        self._collection.ensure_index(self._timestampfield)
+        _index_checked_at[self._index_key] = now
+
+    def _own(self, rows):
+        """
+        Leaves only rows of this reaper's partition.
+
+        :type rows: list[dict]
+        :rtype: list[dict]
+        """
+        if self._partitions == 1:
+            return list(rows)
+        return [row for row in rows if get_partition(row['_id'], self._partitions) == self._partition]
+
+    def heartbeat(self, node, ttl):
+        now = datetime.datetime.utcnow()
+        name = self._collection.name
+        self._leases.update(
+            {'_id': name + "/" + node},
+            {'$set': {'c': name, 'n': node, 't': now}},
+            upsert=True, w=1
+        )
+        rows = self._leases.find({'c': name, 't': {'$gte': now - datetime.timedelta(seconds=ttl)}}, fields=['n'])
+        return sorted(row['n'] for row in rows)
+
+    def set_partition(self, index, count):
+        self._partition = index
+        self._partitions = max(count, 1)
+        # The pool may hold keys of a partition which is not ours anymore.
+        self._sample_pool = {}
 
     def can_write(self):
         try:
@@ -56,21 +173,202 @@ class Storage(Base):
             return False
 
     def touch_keys(self, keys):
-        self._collection.update(
-            {'_id': {'$in': keys}},
-            {'$set': {self._timestampfield: datetime.datetime.utcnow()}},
-            w=0, multi=True
-        )
+        now = datetime.datetime.utcnow()
+        chunks = [keys[i:i + self._touch_chunk_size] for i in range(0, len(keys), self._touch_chunk_size)]
+        if self._touch_w == 0 or self._touch_max_in_flight == 1 or len(chunks) == 1:
+            # Unacknowledged writes are pipelined anyway, no need in threads.
+            self._touch_chunks(chunks, now)
+            return
+        # Acknowledged writes: keep several bulk requests in flight through
+        # the connection pool, each thread waits for its own replies.
+        num_threads = min(self._touch_max_in_flight, len(chunks))
+        errors = []
+        threads = [
+            threading.Thread(target=self._touch_chunks, args=(chunks[i::num_threads], now, errors))
+            for i in range(num_threads)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+    def _touch_chunks(self, chunks, now, errors=None):
+        """
+        :type chunks: list[list[str]]
+        :type now: datetime.datetime
+        :type errors: list[Exception]
+        :rtype: None
+        """
+        try:
+            bulk = self._collection.initialize_unordered_bulk_op()
+            update = self._get_touch_update(now)
+            for chunk in chunks:
+                bulk.find({'_id': {'$in': chunk}}).update(update)
+            bulk.execute({'w': self._touch_w})
+        except Exception, e:
+            if errors is None:
+                raise
+            errors.append(e)
+
+    def _get_touch_update(self, now):
+        """
+        :type now: datetime.datetime
+        :rtype: dict
+        """
+        update = {'$set': {self._timestampfield: now}}
+        if self._policy.name == "lfu":
+            update['$inc'] = {self._policy.hitsfield: 1}
+        elif self._policy.name == "lru2":
+            update['$push'] = {self._policy.historyfield: {'$each': [now], '$slice': -2}}
+        return update
+
+    def _projection(self, extra=None):
+        """
+        :type extra: dict
+        :rtype: dict
+        """
+        projection = {field: 1 for field in self._policy.fields()}
+        projection.update(extra or {})
+        return projection
+
+    def _rank(self, rows):
+        """
+        Sorts rows by the eviction policy: the first ones are to be evicted first.
+
+        :type rows: list[dict]
+        :rtype: list[dict]
+        """
+        now = datetime.datetime.utcnow()
+        return sorted(rows, key=lambda row: self._policy.score(row, now))
 
     def get_stat(self):
         stat = self._collection.database.command('collStats', self._collection.name)
         return stat['size'], stat['count']
 
+    def get_oldest_timestamp(self, approximate):
+        if approximate:
+            rows = list(self._collection.aggregate([
+                {'$sample': {'size': self._sample_size}},
+                {'$group': {'_id': None, 'ts': {'$min': '$' + self._timestampfield}}},
+            ], cursor={}))
+        else:
+            self._ensure_index()
+            rows = list(self._collection.find(
+                sort=[(self._timestampfield, 1)], limit=1,
+                fields={self._timestampfield: 1, '_id': 0}
+            ))
+            rows = [{'ts': row.get(self._timestampfield)} for row in rows]
+        return rows[0]['ts'] if rows else None
+
     def clean_oldest(self, count):
-        self._collection.ensure_index(self._timestampfield)
-        rows = self._collection.find(sort=[(self._timestampfield, 1)], limit=count, fields=['_id'])
+        self._ensure_index()
+        # Other reapers remove keys of their partitions from the same oldest
+        # ones: look through all their shares to find count keys of ours.
+        limit = count * self._partitions
+        if self._policy.name == "lru":
+            rows = self._own(self._collection.find(
+                sort=[(self._timestampfield, 1)], limit=limit, fields=['_id']
+            ))[0:count]
+        else:
+            # Rank a window of the least recently used keys by the policy.
+            rows = self._rank(self._own(self._collection.find(
+                sort=[(self._timestampfield, 1)], limit=limit * self._candidates_factor,
+                fields=self._projection()
+            )))[0:count]
         to_del = map(lambda row: row['_id'], rows)
         self._log.debug("IDs to delete: %s", to_del)
         if to_del:
             self._collection.remove({"_id": {"$in": to_del}})
         return len(to_del)
+
+    def clean_oldest_bytes(self, num_bytes, max_count):
+        self._ensure_index()
+        rows = self._own(self._collection.aggregate([
+            {'$sort': {self._timestampfield: 1}},
+            {'$limit': max_count * self._partitions},
+            {'$project': self._projection({'size': {'$bsonSize': '$$ROOT'}})},
+        ], cursor={}))
+        if self._policy.name != "lru":
+            rows = self._rank(rows)
+        elif self._size_weight > 0 and rows:
+            # Prefer large cold documents: score = age * size^weight. Never
+            # touched documents (no timestamp) are the coldest ones.
+            now = datetime.datetime.utcnow()
+            ages = [(now - row[self._timestampfield]).total_seconds() for row in rows if row.get(self._timestampfield)]
+            max_age = max(ages) if ages else 1
+
+            def score(row):
+                ts = row.get(self._timestampfield)
+                age = (now - ts).total_seconds() if ts else max_age
+                return max(age, 1) * (max(row['size'], 1) ** self._size_weight)
+            rows.sort(key=score, reverse=True)
+        to_del = []
+        freed = 0
+        for row in rows:
+            if freed >= num_bytes:
+                break
+            to_del.append(row['_id'])
+            freed += row['size']
+        self._log.debug("IDs to delete: %s", to_del)
+        if to_del:
+            self._collection.remove({"_id": {"$in": to_del}})
+        return len(to_del), freed
+
+    def clean_oldest_range(self, count):
+        self._ensure_index()
+        # Walks the index on the server side, only one document is returned.
+        rows = list(self._collection.find(
+            sort=[(self._timestampfield, 1)], skip=max(count - 1, 0), limit=1,
+            fields={self._timestampfield: 1, '_id': 0}
+        ))
+        if not rows or rows[0].get(self._timestampfield) is None:
+            # Too few documents or the cutoff is among documents without
+            # timestamp at all (never touched): fall back to removal by IDs.
+            return self.clean_oldest(count)
+        cutoff = rows[0][self._timestampfield]
+        self._log.debug("Cutoff timestamp: %s", cutoff)
+        # Less than count keys are older than the cutoff.
+        removed = self._collection.remove(
+            {'$or': [{self._timestampfield: {'$lt': cutoff}}, {self._timestampfield: None}]},
+            w=1
+        )['n']
+        if removed < count:
+            # Touched keys share the same timestamp per bulk, so thousands
+            # of keys may be at the cutoff: remove only the rest of count.
+            rows = self._collection.find({self._timestampfield: cutoff}, limit=count - removed, fields=['_id'])
+            to_del = [row['_id'] for row in rows]
+            self._log.debug("IDs to delete at the cutoff: %s", to_del)
+            if to_del:
+                # A key touched after it was found is not removed.
+                removed += self._collection.remove(
+                    {'_id': {'$in': to_del}, self._timestampfield: cutoff},
+                    w=1
+                )['n']
+        return removed
+
+    def clean_sampled(self, count):
+        # Like in Redis: merge a fresh random sample into the pool of the
+        # best candidates kept between rounds, and evict the oldest of them.
+        rows = self._own(self._collection.aggregate([
+            {'$sample': {'size': self._sample_size * self._partitions}},
+            {'$project': self._projection()},
+        ], cursor={}))
+        pool = self._sample_pool
+        for row in rows:
+            pool[row['_id']] = row
+        candidates = self._rank(pool.values())
+        to_del = candidates[0:count]
+        self._sample_pool = {row['_id']: row for row in candidates[count:count + self._sample_pool_size]}
+        self._log.debug("IDs to delete: %s", [row['_id'] for row in to_del])
+        if not to_del:
+            return 0
+        # A candidate could have been touched after it was sampled: remove
+        # it only if its timestamp is still the same.
+        bulk = self._collection.initialize_unordered_bulk_op()
+        for row in to_del:
+            _id, ts = row['_id'], row.get(self._timestampfield)
+            cond = {'$lte': ts} if ts is not None else None
+            bulk.find({'_id': _id, self._timestampfield: cond}).remove_one()
+        return bulk.execute({'w': 1})['nRemoved']
@@ -0,0 +1,110 @@
+import time
+
+
+class Child(object):
+    """
+    State of one supervised child process.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.started_at = None
+        self.next_start_at = 0
+        self.failures = 0  # consecutive deaths, each one doubles the delay
+        self.restarts = 0  # total, for logging only
+
+
+class Supervisor(object):
+    """
+    Keeps each child process running independently: when a child dies,
+    only that child is restarted, and other ones keep working. This is
+    safe because every listener/updater pair talks through its own ring,
+    which a killed process never leaves inconsistent.
+
+    A child which dies again and again is restarted with an exponential
+    backoff (backoff_min, 2 * backoff_min, ... up to backoff_max seconds),
+    so a persistent failure (e.g. a busy port) does not turn into a fork
+    storm. A child which has been running for stable_time seconds is
+    considered healthy again, and its next restart is immediate.
+    """
+
+    def __init__(self, log, backoff_min, backoff_max, stable_time):
+        """
+        :type log: logging.Logger
+        :type backoff_min: float
+        :type backoff_max: float
+        :type stable_time: float
+        """
+        self._log = log
+        self._backoff_min = backoff_min
+        self._backoff_max = backoff_max
+        self._stable_time = stable_time
+        self._children = {}
+
+    def ensure(self, name, factory, now=None):
+        """
+        Starts a process created by factory() if the child with this name
+        is not running and its restart delay has passed. Returns True if the
+        child is running after the call.
+
+        :type name: str
+        :type factory: callable
+        :type now: float
+        :rtype: bool
+        """
+        if now is None:
+            now = time.time()
+        child = self._children.get(name)
+        if child is None:
+            child = self._children[name] = Child()
+        p = child.process
+        if p is not None:
+            if p.is_alive():
+                if child.failures and now >= child.started_at + self._stable_time:
+                    child.failures = 0
+                return True
+            uptime = now - child.started_at
+            if uptime >= self._stable_time:
+                child.failures = 0
+            delay = 0
+            if child.failures:
+                delay = min(self._backoff_min * 2 ** (child.failures - 1), self._backoff_max)
+            child.failures += 1
+            child.restarts += 1
+            child.next_start_at = now + delay
+            child.process = None
+            self._log.warning(
+                "The %s (pid=%d) died unexpectedly with exit code %s after %d seconds, restart #%d in %d seconds",
+                name, p.pid, p.exitcode, uptime, child.restarts, delay
+            )
+        if now < child.next_start_at:
+            return False
+        child.process = factory()
+        child.process.start()
+        child.started_at = now
+        self._log.info("Spawned a new %s: pid=%d", name, child.process.pid)
+        return True
+
+    def processes(self, names=None):
+        """
+        Returns running processes of the given children (all if None).
+
+        :type names: list[str]|None
+        :rtype: list[multiprocessing.Process]
+        """
+        if names is None:
+            names = self._children.keys()
+        return [
+            self._children[name].process
+            for name in names
+            if name in self._children and self._children[name].process is not None
+        ]
+
+    def forget(self, name):
+        """
+        Stops tracking a child (the caller must stop its process first).
+
+        :type name: str
+        :rtype: None
+        """
+        self._children.pop(name, None)
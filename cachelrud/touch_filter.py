@@ -0,0 +1,61 @@
+import time
+
+
+class TouchFilter(object):
+    """
+    Remembers recently touched keys to skip touching them again within
+    min_interval seconds: LRU order of a key touched a minute ago almost
+    never matters, but each touch is a write to the database master.
+
+    Keys are stored in two generations (current and previous) of at most
+    max_keys entries each. The current generation becomes previous every
+    min_interval seconds (or earlier if it is full), and the old previous
+    one is dropped entirely, so memory is bounded and there is no per-key
+    expiration work.
+    """
+
+    def __init__(self, min_interval, max_keys, now=None):
+        """
+        :type min_interval: float
+        :type max_keys: int
+        :type now: float
+        """
+        self._min_interval = min_interval
+        self._max_keys = max_keys
+        self._current = {}
+        self._previous = {}
+        self._rotated_at = time.time() if now is None else now
+
+    def filter(self, keys, now=None):
+        """
+        Returns keys which are to be touched and remembers them as touched
+        at the moment now.
+
+        :type keys: list[str]
+        :type now: float
+        :rtype: list[str]
+        """
+        if self._min_interval <= 0:
+            return keys
+        if now is None:
+            now = time.time()
+        if now >= self._rotated_at + self._min_interval or len(self._current) >= self._max_keys:
+            self._previous = self._current
+            self._current = {}
+            self._rotated_at = now
+        current = self._current
+        previous = self._previous
+        threshold = now - self._min_interval
+        result = []
+        for key in keys:
+            touched_at = current.get(key)
+            if touched_at is None:
+                touched_at = previous.get(key)
+                if touched_at is not None and touched_at > threshold:
+                    # Keep it in the current generation to not forget it on rotation.
+                    current[key] = touched_at
+            if touched_at is not None and touched_at > threshold:
+                continue
+            current[key] = now
+            result.append(key)
+        return result